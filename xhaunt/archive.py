@@ -0,0 +1,222 @@
+"""Message archive backing XEP-0313 Message Archive Management
+
+Messages live in the archive table, range partitioned by month on their
+timestamp. Queries page with a (stamp, id) keyset instead of OFFSET so
+fetching any page costs the same however large the archive gets, and
+whole months can be dropped cheaply with prune().
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+import logging
+import re
+
+from psycopg2 import sql
+
+from .batch import BatchQueue
+from .db import HauntDB, columns
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# archive ids are postgresql bigints
+BIGINT_MIN = -2 ** 63
+BIGINT_MAX = 2 ** 63 - 1
+PARTITION_RE = re.compile(r'^archive_y(?P<year>\d{4})m(?P<month>\d{2})$')
+
+ArchivedMessage = namedtuple(
+    'ArchivedMessage',
+    ['id', 'jid', 'with_jid', 'stamp', 'outgoing', 'body'])
+
+
+class Archive(HauntDB):
+    def __init__(self, database, user=None, password=None, host=None,
+                 max_items=100, max_delay=0.005):
+        super(Archive, self).__init__(database, user, password, host)
+        self.queue = BatchQueue(self.add_messages, max_items, max_delay)
+        self._partitions = set()
+
+    def archive_message(self, jid, with_jid, body, outgoing, stamp=None):
+        """Queue a message for the next batched insert
+
+        :args:
+           jid (str): bare JID of the user owning the archive
+           with_jid (str): bare JID of the contact
+           body (str): message text
+           outgoing (bool): True if the user sent the message
+           stamp (datetime): when the message was sent, defaults to now
+
+        :returns:
+           future set to the archive id of the message, or None if
+           jid has no account
+        """
+        if stamp is None:
+            stamp = datetime.now(timezone.utc)
+        return self.queue.submit((jid, with_jid, stamp, outgoing, body))
+
+    async def add_messages(self, messages):
+        """Insert a list of (jid, with_jid, stamp, outgoing, body) tuples
+
+        :returns:
+           list of archive ids in the same order as messages, None for
+           messages whose jid has no account
+        """
+        async with self.lock:
+            await self._ensure_partitions(message[2] for message in messages)
+
+            await self.connect()
+            cur = await self.conn.cursor()
+            # reserve the ids up front so they can be matched back to messages
+            await cur.execute("select nextval('archive_id_seq') from generate_series(1, %s)",
+                              (len(messages),))
+            ids = [row[0] for row in await cur.fetchall()]
+            await cur.execute("""
+insert into archive ("id", "jid", "with_jid", "stamp", "outgoing", "body")
+  select m.* from unnest(%s::bigint[], %s::varchar[], %s::varchar[], %s::timestamptz[], %s::boolean[], %s::text[])
+    as m(id, jid, with_jid, stamp, outgoing, body)
+  where m.jid in (select jid from users)
+  returning id""", [ids] + columns(messages))
+            inserted = set(row[0] for row in await cur.fetchall())
+        return [i if i in inserted else None for i in ids]
+
+    async def _ensure_partitions(self, stamps):
+        """Create the monthly partitions needed to store these timestamps
+
+        Must be called holding self.lock.
+        """
+        months = set(month_start(stamp) for stamp in stamps)
+        missing = [month for month in months if month not in self._partitions]
+        if not missing:
+            return
+
+        await self.connect()
+        cur = await self.conn.cursor()
+        for month in sorted(missing):
+            await cur.execute(
+                sql.SQL('create table if not exists {} partition of archive for values from (%s) to (%s)').format(
+                    sql.Identifier(partition_name(month))),
+                (month, next_month(month)))
+            self._partitions.add(month)
+
+    async def query(self, jid, with_jid=None, start=None, end=None,
+                    after=None, before=None, limit=50):
+        """Find archived messages for a user, oldest first
+
+        :args:
+           jid (str): bare JID of the user owning the archive
+           with_jid (str): only messages exchanged with this contact
+           start, end (datetime): only messages within this time range
+           after (str): page token, return the messages following it
+           before (str): page token, return the messages preceding it.
+               The empty string asks for the last page.
+           limit (int): maximum number of messages to return
+
+        :returns:
+           (messages, complete) where complete is True if there are no
+           more messages in the direction being paged
+        """
+        conditions = [sql.SQL('jid = %s')]
+        parameters = [jid]
+        if with_jid is not None:
+            conditions.append(sql.SQL('with_jid = %s'))
+            parameters.append(with_jid)
+        if start is not None:
+            conditions.append(sql.SQL('stamp >= %s'))
+            parameters.append(start)
+        if end is not None:
+            conditions.append(sql.SQL('stamp <= %s'))
+            parameters.append(end)
+
+        backwards = before is not None
+        if after:
+            stamp, archive_id = decode_token(after)
+            # the plain stamp comparison lets the planner prune partitions
+            conditions.append(sql.SQL('stamp >= %s and (stamp, id) > (%s, %s)'))
+            parameters.extend([stamp, stamp, archive_id])
+        if before:
+            stamp, archive_id = decode_token(before)
+            conditions.append(sql.SQL('stamp <= %s and (stamp, id) < (%s, %s)'))
+            parameters.extend([stamp, stamp, archive_id])
+
+        order = sql.SQL('stamp desc, id desc' if backwards else 'stamp, id')
+        query = sql.SQL(
+            'select id, jid, with_jid, stamp, outgoing, body from archive where {} order by {} limit %s').format(
+                sql.SQL(' and ').join(conditions), order)
+        parameters.append(limit + 1)
+
+        async with self.lock:
+            await self.connect()
+            cur = await self.conn.cursor()
+            await cur.execute(query, parameters)
+            rows = [ArchivedMessage(*row) for row in await cur.fetchall()]
+
+        complete = len(rows) <= limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+        return rows, complete
+
+    async def prune(self, older_than):
+        """Drop monthly partitions holding only messages before older_than
+
+        :returns:
+           list of dropped partition names
+        """
+        async with self.lock:
+            await self.connect()
+            cur = await self.conn.cursor()
+            await cur.execute("""
+select c.relname from pg_inherits i
+  join pg_class c on c.oid = i.inhrelid
+  join pg_class p on p.oid = i.inhparent
+  where p.relname = 'archive'""")
+            dropped = []
+            for (name,) in await cur.fetchall():
+                match = PARTITION_RE.match(name)
+                if match is None:
+                    continue
+                month = datetime(int(match.group('year')), int(match.group('month')), 1, tzinfo=timezone.utc)
+                if next_month(month) <= older_than:
+                    dropped.append((month, name))
+
+            for month, name in sorted(dropped):
+                logger.info('Dropping archive partition %s', name)
+                await cur.execute(sql.SQL('drop table {}').format(sql.Identifier(name)))
+                self._partitions.discard(month)
+        return [name for month, name in sorted(dropped)]
+
+
+def month_start(stamp):
+    stamp = stamp.astimezone(timezone.utc)
+    return datetime(stamp.year, stamp.month, 1, tzinfo=timezone.utc)
+
+
+def next_month(month):
+    if month.month == 12:
+        return month.replace(year=month.year + 1, month=1)
+    return month.replace(month=month.month + 1)
+
+
+def partition_name(month):
+    return 'archive_y{:04d}m{:02d}'.format(month.year, month.month)
+
+
+def encode_token(message):
+    """Encode a message's (stamp, id) keyset position as an RSM id
+    """
+    microseconds = (message.stamp - EPOCH) // timedelta(microseconds=1)
+    return '{}-{}'.format(microseconds, message.id)
+
+
+def decode_token(token):
+    """Decode an RSM id from encode_token back into (stamp, id)
+
+    raises ValueError if the token is malformed or out of range
+    """
+    microseconds, archive_id = token.rsplit('-', 1)
+    archive_id = int(archive_id)
+    if not BIGINT_MIN <= archive_id <= BIGINT_MAX:
+        raise ValueError('archive id {} out of range'.format(archive_id))
+    try:
+        return EPOCH + timedelta(microseconds=int(microseconds)), archive_id
+    except OverflowError as e:
+        raise ValueError('timestamp out of range: {}'.format(e))
@@ -1,6 +1,7 @@
 import psycopg2
 
 from hangups import auth
+from hangups.auth import GoogleAuthError
 
 
 class CredentialsPrompt:
@@ -0,0 +1,137 @@
+"""Content addressed avatar cache shared by every user of the gateway
+
+Avatars are stored once on disk under their SHA-1, which is also the
+XEP-0153 photo hash. An LRU maps recently seen avatar URLs to their
+hash so repeated lookups skip the network, and concurrent fetches of
+one URL share a single download.
+"""
+import asyncio
+import base64
+from collections import OrderedDict
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+IMAGE_TYPES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+class AvatarCache:
+    """Download and store avatars by content hash
+
+    :args:
+       directory (str): where avatar files are stored
+       max_urls (int): number of URL to hash mappings kept in memory
+       timeout (float): seconds allowed for downloading one avatar
+       max_bytes (int): largest avatar accepted
+    """
+    def __init__(self, directory, max_urls=4096, timeout=30, max_bytes=1024 * 1024):
+        self.directory = directory
+        self.max_urls = max_urls
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.urls = OrderedDict()
+        self._fetching = {}
+        self._session = None
+
+    def path(self, sha1):
+        return os.path.join(self.directory, sha1[:2], sha1)
+
+    def has(self, sha1):
+        return os.path.exists(self.path(sha1))
+
+    async def fetch(self, url):
+        """Return the SHA-1 of the avatar at url, downloading it if needed
+        """
+        sha1 = self.urls.get(url)
+        if sha1 is not None and self.has(sha1):
+            self.urls.move_to_end(url)
+            return sha1
+
+        pending = self._fetching.get(url)
+        if pending is not None:
+            return await pending
+
+        pending = self._fetching[url] = asyncio.ensure_future(self._download(url))
+        try:
+            sha1 = await pending
+        finally:
+            del self._fetching[url]
+
+        self.urls[url] = sha1
+        self.urls.move_to_end(url)
+        while len(self.urls) > self.max_urls:
+            self.urls.popitem(last=False)
+        return sha1
+
+    async def _download(self, url):
+        import aiohttp
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with self._session.get(url, timeout=timeout) as response:
+            response.raise_for_status()
+            if response.content_length is not None and response.content_length > self.max_bytes:
+                raise ValueError('Avatar {} is {} bytes, more than {}'.format(
+                    url, response.content_length, self.max_bytes))
+            # the length may be missing or wrong, so count what arrives
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data.extend(chunk)
+                if len(data) > self.max_bytes:
+                    raise ValueError('Avatar {} is more than {} bytes'.format(url, self.max_bytes))
+            data = bytes(data)
+        if not data:
+            raise ValueError('Avatar {} is empty'.format(url))
+
+        sha1 = hashlib.sha1(data).hexdigest()
+        if not self.has(sha1):
+            self._write(sha1, data)
+        logger.debug('Cached avatar %s from %s', sha1, url)
+        return sha1
+
+    def _write(self, sha1, data):
+        path = self.path(sha1)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write and rename, so readers never see a partial file
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as outstream:
+                outstream.write(data)
+            os.replace(temporary, path)
+        except Exception:
+            os.unlink(temporary)
+            raise
+
+    def read_base64(self, sha1):
+        """Return (mime type, base64 text) of a stored avatar
+
+        The file is memory mapped so the image is encoded straight from
+        the page cache without an intermediate copy.
+        """
+        with open(self.path(sha1), 'rb') as instream:
+            with mmap.mmap(instream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return image_type(data), base64.b64encode(data).decode('ascii')
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def image_type(data):
+    """Guess an image's mime type from its first bytes
+    """
+    for magic, mime_type in IMAGE_TYPES:
+        if data[:len(magic)] == magic:
+            return mime_type
+    return 'application/octet-stream'
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BatchQueue:
+    """Collect items and hand them to a coroutine in batches
+
+    A batch is written once max_items are waiting, or max_delay seconds
+    after the first item of the batch was submitted, whichever comes
+    first. Batches are written one at a time in submission order.
+
+    :args:
+       write_batch: coroutine function taking a list of items and
+           returning a list with one result per item
+       max_items: flush as soon as this many items are waiting
+       max_delay: longest time in seconds an item waits for its batch
+    """
+    def __init__(self, write_batch, max_items=100, max_delay=0.005):
+        self.write_batch = write_batch
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self._pending = []
+        self._timer = None
+        self._lock = None
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def writing(self):
+        """Is a batch being written right now"""
+        return bool(self._tasks)
+
+    def submit(self, item):
+        """Queue an item for the next batch
+
+        :returns:
+           future set to the item's result once its batch is written,
+           or to the exception if the batch failed. The future may be
+           dropped; a failed batch is logged here.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_items:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._start_flush)
+        return future
+
+    def _start_flush(self):
+        task = asyncio.ensure_future(self._write(self._take()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _take(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        return batch
+
+    async def flush(self):
+        """Write everything that is currently queued
+
+        Waits for any batches already being written as well, so items
+        still reach write_batch in submission order.
+        """
+        if self._pending:
+            self._start_flush()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def _write(self, batch):
+        if not batch:
+            return
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            try:
+                results = await self.write_batch([item for item, _ in batch])
+            except Exception as e:
+                logger.error('Writing batch of %d items failed: %s', len(batch), e)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                        # logged once above, callers that dropped the
+                        # future shouldn't each log it again
+                        future.exception()
+                return
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def close(self):
+        """Flush remaining items before shutting down
+        """
+        await self.flush()
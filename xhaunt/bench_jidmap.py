@@ -0,0 +1,73 @@
+"""Measure per stanza address handling cost with and without the jidmap caches
+
+Run with python -m xhaunt.bench_jidmap
+"""
+import argparse
+import timeit
+
+from hangups.user import UserID
+from slixmpp.jid import JID
+
+from . import jidmap
+
+DOMAIN = 'hangouts.example.net'
+
+
+def uncached_user_jid(user_id, domain):
+    return JID(user_id.gaia_id + '@' + domain)
+
+
+def uncached_conversation_jid(conversation_id, domain):
+    escaped = jidmap.escape_node.__wrapped__(conversation_id)
+    return JID(jidmap.encode_case(escaped) + '@' + domain)
+
+
+def uncached_lookup(bare, domain):
+    jid = JID(bare)
+    if jid.domain != domain or not jid.user:
+        return None
+    if jid.user.isdigit():
+        return UserID(chat_id=jid.user, gaia_id=jid.user)
+    return jidmap.unescape_node.__wrapped__(jidmap.decode_case(jid.user))
+
+
+def stanza_uncached(user_id, conversation_id, sender):
+    """Address work for relaying one message in each direction"""
+    uncached_user_jid(user_id, DOMAIN)
+    uncached_conversation_jid(conversation_id, DOMAIN)
+    uncached_lookup(sender, DOMAIN)
+
+
+def stanza_cached(user_id, conversation_id, sender):
+    jidmap.user_jid(user_id, DOMAIN)
+    jidmap.conversation_jid(conversation_id, DOMAIN)
+    jidmap.lookup(sender, DOMAIN)
+
+
+def main(cmdline=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='stanzas per measurement')
+    parser.add_argument('--contacts', type=int, default=500,
+                        help='distinct contacts and conversations cycled through')
+    args = parser.parse_args(cmdline)
+
+    contacts = [(UserID(chat_id=str(10 ** 20 + i), gaia_id=str(10 ** 20 + i)),
+                 'UgwConversation{}_4AaABAQ'.format(i),
+                 str(jidmap.conversation_jid('UgwConversation{}_4AaABAQ'.format(i), DOMAIN)))
+                 for i in range(args.contacts)]
+
+    def run(handle):
+        for i in range(args.number):
+            handle(*contacts[i % len(contacts)])
+
+    for name, handle in [('uncached', stanza_uncached), ('cached', stanza_cached)]:
+        seconds = min(timeit.repeat(lambda: run(handle), number=1, repeat=5))
+        print('{:>8}: {:6.2f} us/stanza'.format(name, seconds / args.number * 1e6))
+
+    for name, info in sorted(jidmap.cache_info().items()):
+        print('{:>16}: hits={} misses={} size={}'.format(name, info.hits, info.misses, info.currsize))
+
+
+if __name__ == '__main__':
+    main()
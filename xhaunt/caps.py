@@ -0,0 +1,61 @@
+"""Persistent XEP-0115 entity capabilities cache
+
+slixmpp's xep_0115 plugin looks verification strings up synchronously,
+so CapsCache answers from memory. The table is read once by load() when
+the component starts, and newly verified strings are written back in
+batches.
+"""
+import logging
+
+from slixmpp.plugins.xep_0030.stanza import DiscoInfo
+from slixmpp.util.cache import Cache
+from slixmpp.xmlstream import ET
+
+from .batch import BatchQueue
+from .db import HauntDB, columns
+
+logger = logging.getLogger(__name__)
+
+
+class CapsCache(HauntDB, Cache):
+    def __init__(self, database, user=None, password=None, host=None,
+                 max_items=100, max_delay=0.5):
+        super(CapsCache, self).__init__(database, user, password, host)
+        self.queue = BatchQueue(self.store_many, max_items, max_delay)
+        self.infos = {}
+
+    def retrieve(self, key):
+        return self.infos.get(key)
+
+    def store(self, key, value):
+        if key in self.infos:
+            return True
+        self.infos[key] = value
+        self.queue.submit((key, str(value)))
+        return True
+
+    async def load(self):
+        """Read every cached verification string into memory
+
+        returns the number of cached verification strings
+        """
+        async with self.lock:
+            await self.connect()
+            cur = await self.conn.cursor()
+            await cur.execute('select ver, info from caps')
+            for ver, info in await cur.fetchall():
+                self.infos.setdefault(ver, DiscoInfo(xml=ET.fromstring(info)))
+        logger.debug('Loaded %d cached capabilities', len(self.infos))
+        return len(self.infos)
+
+    async def store_many(self, items):
+        """Write a list of (ver, serialized disco#info) tuples
+        """
+        async with self.lock:
+            await self.connect()
+            cur = await self.conn.cursor()
+            await cur.execute("""
+insert into caps ("ver", "info")
+  select * from unnest(%s::varchar[], %s::text[])
+  on conflict do nothing""", columns(items))
+        return [None] * len(items)
@@ -0,0 +1,143 @@
+"""Command line entry point for the gateway
+
+Run with python -m xhaunt. Log records are formatted and written by a
+background thread, so the event loop only pays for putting them on a
+queue, and startup phases are logged so time to connected can be
+compared between releases.
+"""
+import time
+
+STARTED = time.monotonic()
+
+import argparse
+from configparser import ConfigParser
+import logging
+import logging.handlers
+import queue
+import signal
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+# disconnect and flush queued writes before exiting on these
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='XMPP gateway to Google Hangouts')
+    parser.add_argument('-c', '--config', default='xhang.ini',
+                        help='configuration file to read, default: %(default)s')
+    parser.add_argument('-l', '--log-level', type=str.upper,
+                        choices=LOG_LEVELS,
+                        help='overrides log_level from the configuration file, default: INFO')
+    parser.add_argument('--log-file', help='write logs here instead of stderr')
+    parser.add_argument('--uvloop', action='store_true', default=None,
+                        help='run on the uvloop event loop, overrides use_uvloop')
+    parser.add_argument('--exit-on-connect', action='store_true', default=False,
+                        help='disconnect once the session has started, to time startup')
+    return parser
+
+
+def configure_logging(level, filename=None):
+    """Send log records through a queue to a handler on another thread
+
+    :returns:
+       the started QueueListener, stop it to flush the remaining records
+    """
+    if filename is None:
+        handler = logging.StreamHandler()
+    else:
+        handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def install_uvloop():
+    import asyncio
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def main(cmdline=None):
+    parser = make_parser()
+    args = parser.parse_args(cmdline)
+
+    config = ConfigParser()
+    if not config.read(args.config):
+        parser.error('Unable to read configuration file {}'.format(args.config))
+    defaults = config['DEFAULT']
+
+    level = args.log_level or defaults.get('log_level', 'INFO').upper()
+    if level not in LOG_LEVELS:
+        parser.error('log_level must be one of {}'.format(', '.join(LOG_LEVELS)))
+
+    listener = configure_logging(level, args.log_file or defaults.get('log_file'))
+    try:
+        use_uvloop = args.uvloop if args.uvloop is not None else defaults.getboolean('use_uvloop', False)
+        if use_uvloop:
+            try:
+                install_uvloop()
+            except ImportError:
+                parser.error('uvloop was requested but is not installed')
+        run(defaults, args.exit_on_connect)
+    finally:
+        listener.stop()
+
+
+def run(defaults, exit_on_connect=False):
+    from .component import XHauntComponent
+    imported = time.monotonic()
+
+    xmpp = XHauntComponent(
+        defaults.get('service_name'),
+        defaults.get('secret'),
+        defaults.get('jabber_server', '127.0.0.1'),
+        defaults.getint('jabber_port', 5347),
+        defaults.get('database'),
+        defaults.getboolean('write_behind', False),
+        defaults.get('avatar_directory'),
+        defaults.get('upload_service'))
+    initialized = time.monotonic()
+
+    loop = xmpp.loop
+    stopped = loop.create_future()
+
+    def stop():
+        if stopped.done():
+            return
+        if not xmpp.transport:
+            xmpp.cancel_connection_attempt()
+            stopped.set_result(None)
+            return
+        logger.info('Disconnecting')
+        # slixmpp replaces the disconnected future once it is set
+        xmpp.disconnected.add_done_callback(lambda future: stopped.done() or stopped.set_result(None))
+        xmpp.disconnect()
+
+    def connected(event):
+        now = time.monotonic()
+        logger.info('Startup: imports %.3fs, init %.3fs, connect %.3fs, total %.3fs',
+                    imported - STARTED, initialized - imported, now - initialized, now - STARTED)
+        if exit_on_connect:
+            stop()
+
+    xmpp.add_event_handler('session_start', connected, disposable=True)
+    for signum in STOP_SIGNALS:
+        loop.add_signal_handler(signum, stop)
+    xmpp.connect()
+    try:
+        loop.run_until_complete(stopped)
+    finally:
+        for signum in STOP_SIGNALS:
+            loop.remove_signal_handler(signum)
+        # write out buffered accounts, roster changes and messages
+        loop.run_until_complete(xmpp.shutdown(None))
@@ -0,0 +1,127 @@
+"""Collapse bursts of chat states and receipts before relaying them
+
+Typing notifications and receipts are usually superseded within
+milliseconds, so only the latest one per (user, contact) within a short
+window is passed on.
+"""
+import asyncio
+from collections import Counter
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHATSTATES_NS = 'http://jabber.org/protocol/chatstates'
+RECEIPTS_NS = 'urn:xmpp:receipts'
+CHAT_STATES = ('active', 'composing', 'paused', 'inactive', 'gone')
+
+
+class Coalescer:
+    """Pass on only the latest value per key, window seconds after the first
+
+    The window starts with the first value queued for a key, so a key
+    that keeps changing is still sent at least every window seconds.
+
+    :args:
+       send: function called with (key, value) when the window closes
+       window: seconds values are held for
+    """
+    def __init__(self, send, window=0.25):
+        self.send = send
+        self.window = window
+        self.pending = {}
+        self.stats = Counter()
+        self._timers = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, key, value):
+        self.stats['received'] += 1
+        if key in self.pending:
+            self.stats['coalesced'] += 1
+        self.pending[key] = value
+        if key not in self._timers:
+            self._timers[key] = asyncio.get_event_loop().call_later(
+                self.window, self._fire, key)
+
+    def discard(self, key):
+        """Drop the value waiting for key, if any
+        """
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if self.pending.pop(key, None) is not None:
+            self.stats['discarded'] += 1
+
+    def clear(self):
+        """Drop everything waiting without sending it
+        """
+        for key in list(self.pending):
+            self.discard(key)
+
+    def _fire(self, key):
+        self._timers.pop(key, None)
+        value = self.pending.pop(key)
+        self.stats['sent'] += 1
+        try:
+            self.send(key, value)
+        except Exception as e:
+            logger.error('Sending %s for %s failed: %s', value, key, e)
+
+    def flush(self):
+        """Send everything waiting now
+        """
+        for key in list(self.pending):
+            self._timers.pop(key).cancel()
+            self._fire(key)
+
+
+class ChatStateCoalescer(Coalescer):
+    """Coalesce XEP-0085 chat states per (user, contact)
+
+    States matching the last one sent are dropped, and a message going
+    out cancels any state still waiting, so a composing is never sent
+    after the message it announced.
+    """
+    def __init__(self, send, window=0.25):
+        super(ChatStateCoalescer, self).__init__(send, window)
+        self.last = {}
+
+    def put(self, key, state):
+        if state == self.last.get(key):
+            self.stats['unchanged'] += 1
+            self.discard(key)
+            return
+        super(ChatStateCoalescer, self).put(key, state)
+
+    def message_sent(self, key):
+        """Record that a message was sent for key, which implies active
+        """
+        self.discard(key)
+        self.last[key] = 'active'
+
+    def _fire(self, key):
+        state = self.pending[key]
+        if state == 'gone':
+            self.last.pop(key, None)
+        else:
+            self.last[key] = state
+        super(ChatStateCoalescer, self)._fire(key)
+
+
+def chat_state(msg):
+    """Return the XEP-0085 chat state carried by msg, or None
+    """
+    for state in CHAT_STATES:
+        if msg.xml.find('{%s}%s' % (CHATSTATES_NS, state)) is not None:
+            return state
+    return None
+
+
+def receipt_id(msg):
+    """Return the message id acknowledged by a XEP-0184 receipt in msg, or None
+    """
+    received = msg.xml.find('{%s}received' % (RECEIPTS_NS,))
+    if received is None:
+        return None
+    return received.get('id')
@@ -1,28 +1,89 @@
 import concurrent.futures
 import asyncio
 import logging
+import os
+
+import appdirs
 
 from slixmpp.componentxmpp import ComponentXMPP
+from slixmpp.exceptions import XMPPError
+from slixmpp.plugins.xep_0030.stanza import DiscoInfo
+from slixmpp.plugins.xep_0082 import parse as parse_datetime, format_datetime
+from slixmpp.stanza.presence import Presence
 from slixmpp.xmlstream import ET
 from slixmpp.xmlstream.handler.callback import Callback
 from slixmpp.xmlstream.matcher.xpath import MatchXPath
 
-from .auth import get_auth
-from .db import Users
+from .archive import Archive, encode_token
+from .avatar import AvatarCache
+from .caps import CapsCache
+from .coalesce import CHATSTATES_NS, ChatStateCoalescer, Coalescer, chat_state, receipt_id
+from .db import Users, WriteBehind
+from . import jidmap
+from .media import MediaRelay
+from .offline import OfflineQueue
+from .throttle import CircuitBreaker, Scheduler, Throttled, TokenBucket
 logger = logging.getLogger('xmpp')
 
+MAM_NS = 'urn:xmpp:mam:2'
+RSM_NS = 'http://jabber.org/protocol/rsm'
+MAM_PAGE_SIZE = 50
+MAM_MAX_PAGE_SIZE = 250
+# stanzas per second replayed from the offline queue, shared by all users
+REDELIVERY_RATE = 50
+REDELIVERY_BURST = 100
+UPLOAD_NS = 'urn:xmpp:http:upload:0'
+# the only slot headers XEP-0363 lets an upload service ask for
+UPLOAD_HEADERS = ('Authorization', 'Cookie', 'Expires')
+CAPS_NODE = 'https://github.com/detrout/haunt-gateway'
+# what a transported hangouts contact looks like to XMPP clients
+CONTACT_IDENTITY = ('client', 'pc', 'Hangouts contact')
+CONTACT_FEATURES = [
+    'http://jabber.org/protocol/caps',
+    'http://jabber.org/protocol/chatstates',
+    'http://jabber.org/protocol/disco#info',
+    'vcard-temp',
+]
+
 
 class XHauntComponent(ComponentXMPP):
-    def __init__(self, jid, secret, server, port, database):
+    def __init__(self, jid, secret, server, port, database, write_behind=False,
+                 avatar_directory=None, upload_service=None):
         super(XHauntComponent, self).__init__(jid, secret, server, port)
 
         self.database = database
         self.users = Users(self.database)
+        # optionally group account and roster writes into batched commits
+        self.writer = WriteBehind(self.database) if write_behind else None
+        self.archive = Archive(self.database)
+        self.offline = OfflineQueue(self.database)
+        self.redelivery_bucket = TokenBucket(REDELIVERY_RATE, REDELIVERY_BURST)
+        # bare jid -> resources of users whose clients are online
+        self.available = {}
+        self.caps_cache = CapsCache(self.database)
+        if avatar_directory is None:
+            avatar_directory = os.path.join(appdirs.user_cache_dir('xhaunt'), 'avatars')
+        self.avatars = AvatarCache(avatar_directory)
+        # contact bare jid -> SHA-1 of their avatar
+        self.contact_avatars = {}
+        self.upload_service = upload_service
+        self.media = MediaRelay()
+        # throttles everything sent to hangouts on behalf of users
+        self.scheduler = Scheduler()
+        self.auth_breaker = CircuitBreaker()
+        # (user, contact) bare jids -> latest chat state or receipt, so
+        # bursts are collapsed before being relayed
+        self.user_states = ChatStateCoalescer(self.send_hangouts_chat_state)
+        self.contact_states = ChatStateCoalescer(self.send_chat_state)
+        self.receipts = Coalescer(self.send_watermark)
+        self._shutdown = None
 
         self.add_event_handler('message', self.message)
         self.add_event_handler('session_start', self.start)
         self.add_event_handler('presence_probe', self.probe)
         self.add_event_handler('presence_available', self.presence_available)
+        self.add_event_handler('presence_unavailable', self.presence_unavailable)
+        self.add_event_handler('disconnected', self.shutdown)
 
         self.register_plugin('xep_0004')  # Data Forms
         self.register_plugin('xep_0077')  # In-Band Registration
@@ -30,6 +91,15 @@ class XHauntComponent(ComponentXMPP):
             Callback('In-Band Registration',
                      MatchXPath('{%s}iq/{jabber:iq:register}query' % (self.default_ns,)),
                      self.register))
+        self.register_handler(
+            Callback('Message Archive Management',
+                     MatchXPath('{%s}iq/{%s}query' % (self.default_ns, MAM_NS)),
+                     self.mam_query))
+        self.register_handler(
+            Callback('vCard',
+                     MatchXPath('{%s}iq/{vcard-temp}vCard' % (self.default_ns,)),
+                     self.vcard_query))
+        self.add_filter('out', self._add_photo_hash)
         self.register_plugin('xep_0199')  # Ping
         self.register_plugin('xep_0092')  # Software Version
         self.register_plugin('xep_0030')  # Service Discovery
@@ -38,19 +108,373 @@ class XHauntComponent(ComponentXMPP):
             itype='hangouts',
             name='Hangouts Gateway')
         self.plugin['xep_0030'].add_feature('jabber:iq:register')
+        self.plugin['xep_0030'].add_feature(MAM_NS)
+        self.plugin['xep_0030'].api.register(self.get_info, 'get_info')
+        self.register_plugin('xep_0115', {  # Entity Capabilities
+            'cache': self.caps_cache,
+            'caps_node': CAPS_NODE})
+        self.plugin['xep_0115'].api.register(self.get_verstring, 'get_verstring')
+
+        self.contact_info = DiscoInfo()
+        self.contact_info.add_identity(*CONTACT_IDENTITY)
+        for feature in CONTACT_FEATURES:
+            self.contact_info.add_feature(feature)
+        self.contact_ver = self.plugin['xep_0115'].generate_verstring(
+            self.contact_info, self.plugin['xep_0115'].hash)
+        self.gateway_ver = None
 
     def message(self, msg):
+        key = (msg['from'].bare, msg['to'].bare)
+        receipt = receipt_id(msg)
+        if receipt is not None:
+            self.receipts.put(key, receipt)
+            return
+        if msg['body']:
+            self.user_states.message_sent(key)
+        else:
+            state = chat_state(msg)
+            if state is not None:
+                self.user_states.put(key, state)
+                return
+
+        if msg['type'] in ('chat', 'normal') and msg['body']:
+            self.archive_message(msg)
         msg.reply('Poke').send()
 
-    def start(self, event):
+    def send_hangouts_chat_state(self, key, state):
+        """Pass a user's coalesced chat state on to Hangouts
+
+        Fires hangouts_chat_state with the user, contact and state.
+        """
+        jid, contact = key
+        self.event('hangouts_chat_state', {'jid': jid, 'contact': contact, 'state': state})
+
+    def send_watermark(self, key, message_id):
+        """Pass the latest message a user acknowledged on to Hangouts
+
+        Fires hangouts_watermark with the user, contact and message id,
+        once per batch of receipts.
+        """
+        jid, contact = key
+        self.event('hangouts_watermark', {'jid': jid, 'contact': contact, 'id': message_id})
+
+    def relay_chat_state(self, mto, mfrom, state):
+        """Queue a contact's chat state for the user
+
+        :args:
+           mto: user the contact is talking to
+           mfrom: contact whose state changed
+           state: XEP-0085 chat state
+        """
+        self.contact_states.put((jidmap.parse_jid(str(mto)).bare,
+                                 jidmap.parse_jid(str(mfrom)).bare), state)
+
+    def send_chat_state(self, key, state):
+        """Send a contact's coalesced chat state if the user is online
+
+        Chat states are stale by the time anyone reads the offline
+        queue, so they are dropped rather than queued.
+        """
+        jid, contact = key
+        if jid not in self.available:
+            return
+        msg = self.make_message(mto=jid, mfrom=contact, mtype='chat')
+        msg.append(ET.Element('{%s}%s' % (CHATSTATES_NS, state)))
+        msg.send()
+
+    def archive_message(self, msg):
+        """Queue a relayed chat message for the message archive
+
+        Messages addressed to the gateway's domain were sent by the user,
+        anything else is on its way to the user from a contact.
+
+        :returns:
+           future set to the message's archive id
+        """
+        outgoing = msg['to'].domain == self.boundjid.domain
+        if outgoing:
+            jid, with_jid = msg['from'].bare, msg['to'].bare
+        else:
+            jid, with_jid = msg['to'].bare, msg['from'].bare
+        return self.archive.archive_message(jid, with_jid, msg['body'], outgoing)
+
+    async def start(self, event):
         logger.debug('starting')
         logger.debug(self.roster)
+        self.update_gateway_ver()
+        await self.caps_cache.load()
+
+    def update_gateway_ver(self):
+        """Compute the caps verstring advertised for the gateway itself
+        """
+        disco = self.plugin['xep_0030']
+        info = disco.static.get_info(self.boundjid, None, None, None)
+        self.gateway_ver = self.plugin['xep_0115'].generate_verstring(
+            info, self.plugin['xep_0115'].hash)
+        disco.set_info(jid=self.boundjid, node='%s#%s' % (CAPS_NODE, self.gateway_ver), info=info)
+
+    def contact_jid(self, contact):
+        """Return the JID for a hangups UserID or conversation id
+        """
+        if isinstance(contact, str):
+            return jidmap.conversation_jid(contact, self.boundjid.domain)
+        return jidmap.user_jid(contact, self.boundjid.domain)
+
+    def contact_id(self, jid):
+        """Return the hangups UserID or conversation id jid stands for
+
+        None if jid is not one of the gateway's contacts
+        """
+        return jidmap.lookup(jid.bare, self.boundjid.domain)
+
+    def is_contact(self, jid):
+        """Is jid a transported contact, e.g. gaia_id@gateway
+        """
+        return jid.domain == self.boundjid.domain and bool(jid.user)
+
+    def get_info(self, jid, node, ifrom, data):
+        """Answer disco#info for contacts from the shared contact_info
+
+        Everything else is left to the static xep_0030 handler.
+        """
+        if self.is_contact(jid):
+            if node in (None, '', '%s#%s' % (CAPS_NODE, self.contact_ver)):
+                return self.contact_info
+            raise XMPPError(condition='item-not-found')
+        return self.plugin['xep_0030'].static.get_info(jid, node, ifrom, data)
+
+    def get_verstring(self, jid, node, ifrom, data):
+        """Return the precomputed verstring for the gateway and its contacts
+
+        Other JIDs are users' clients, whose verstrings are tracked by
+        the xep_0115 plugin.
+        """
+        if self.is_contact(jid):
+            return self.contact_ver
+        if jid.domain == self.boundjid.domain:
+            return self.gateway_ver
+        return self.plugin['xep_0115'].static.get_verstring(jid, node, ifrom, data)
 
     def probe(self, event):
         logger.debug('probe %s', event)
 
-    def presence_available(self, *args, **kwargs):
-        logger.debug('pa %s', str(args))
+    def presence_available(self, presence):
+        logger.debug('pa %s', presence)
+        jid = presence['from']
+        resources = self.available.setdefault(jid.bare, set())
+        if not resources:
+            self.redeliver(jid.bare)
+        resources.add(jid.resource)
+
+    def presence_unavailable(self, presence):
+        jid = presence['from']
+        resources = self.available.get(jid.bare, set())
+        resources.discard(jid.resource)
+        if not resources:
+            self.available.pop(jid.bare, None)
+
+    def deliver(self, stanza):
+        """Send a stanza to a user, or queue it while they are offline
+
+        Stanzas are also queued while older ones are being redelivered,
+        so the user receives everything in order.
+
+        :returns:
+           None if the stanza was sent, otherwise a future set to its
+           offline queue id
+        """
+        target = stanza['to'].bare
+        if target in self.available and not self.offline.is_draining(target):
+            stanza.send()
+            return None
+        return self.offline.enqueue(target, str(stanza))
+
+    def redeliver(self, jid):
+        """Send stanzas queued while jid was offline
+
+        :returns:
+           future set to the number of stanzas sent
+        """
+        return self.offline.redeliver(jid, self.send_raw, self.redelivery_bucket,
+                                      available=lambda: jid in self.available)
+
+    def shutdown(self, event):
+        """Flush queued work when the connection to the server is lost
+
+        Not named disconnected, XMLStream uses that name for a future.
+        The disconnected event does not wait for its handlers, so this
+        returns a future for the flush; calls made while one is running
+        share it, letting the entry point wait for it before exiting.
+        """
+        if self._shutdown is None or self._shutdown.done():
+            self._shutdown = self.loop.create_task(self._flush_queues())
+        return self._shutdown
+
+    async def _flush_queues(self):
+        self.user_states.flush()
+        self.receipts.flush()
+        self.contact_states.clear()
+        if self.writer is not None:
+            await self.writer.shutdown()
+        await self.archive.queue.close()
+        await self.offline.queue.close()
+        await self.caps_cache.queue.close()
+        await self.avatars.close()
+        await self.media.close()
+
+    async def set_contact_avatar(self, jid, url):
+        """Fetch a contact's avatar and advertise it in their presence
+        """
+        self.contact_avatars[jid.bare] = await self.avatars.fetch(url)
+
+    async def request_upload_slot(self, filename, size, content_type=None, ifrom=None):
+        """Ask the upload service for a XEP-0363 slot
+
+        :returns:
+           (put_url, headers, get_url)
+        """
+        iq = self.make_iq_get(ito=self.upload_service, ifrom=ifrom or self.boundjid)
+        request = ET.Element('{%s}request' % (UPLOAD_NS,), {'filename': filename, 'size': str(size)})
+        if content_type is not None:
+            request.set('content-type', content_type)
+        iq.set_payload(request)
+        result = await iq.send()
+
+        slot = result.xml.find('{%s}slot' % (UPLOAD_NS,))
+        put = slot.find('{%s}put' % (UPLOAD_NS,))
+        headers = {}
+        for header in put.findall('{%s}header' % (UPLOAD_NS,)):
+            if header.get('name') in UPLOAD_HEADERS:
+                headers[header.get('name')] = header.text or ''
+        return put.get('url'), headers, slot.find('{%s}get' % (UPLOAD_NS,)).get('url')
+
+    async def relay_attachment(self, mto, mfrom, source_url, filename, size, content_type=None):
+        """Upload a Hangouts attachment and send the user a link to it
+
+        :args:
+           mto: user receiving the attachment
+           mfrom: contact who sent it
+           source_url: where to download the attachment from Hangouts
+           filename, size, content_type: describe the attachment for the
+               upload slot request
+        """
+        put_url, headers, get_url = await self.request_upload_slot(
+            filename, size, content_type, ifrom=mfrom)
+        await self.media.relay(source_url, put_url, size, headers, content_type)
+
+        msg = self.make_message(mto=mto, mfrom=mfrom, mbody=get_url, mtype='chat')
+        oob = ET.Element('{jabber:x:oob}x')
+        ET.SubElement(oob, '{jabber:x:oob}url').text = get_url
+        msg.append(oob)
+        self.contact_states.message_sent((msg['to'].bare, msg['from'].bare))
+        return self.deliver(msg)
+
+    async def vcard_query(self, iq):
+        """Answer a XEP-0054 vCard request for a contact with their avatar
+        """
+        if iq.get('type') != 'get':
+            return
+
+        vcard = ET.Element('{vcard-temp}vCard')
+        sha1 = self.contact_avatars.get(iq['to'].bare)
+        if sha1 is not None and self.avatars.has(sha1):
+            mime_type, data = await self.loop.run_in_executor(
+                None, self.avatars.read_base64, sha1)
+            photo = ET.SubElement(vcard, '{vcard-temp}PHOTO')
+            ET.SubElement(photo, '{vcard-temp}TYPE').text = mime_type
+            ET.SubElement(photo, '{vcard-temp}BINVAL').text = data
+
+        reply = iq.reply()
+        reply.set_payload(vcard)
+        await reply.send()
+
+    def _add_photo_hash(self, stanza):
+        """Add the XEP-0153 avatar hash to available presence from contacts
+        """
+        if not isinstance(stanza, Presence):
+            return stanza
+        if stanza['type'] not in ('available', 'chat', 'away', 'dnd', 'xa'):
+            return stanza
+
+        sha1 = self.contact_avatars.get(stanza['from'].bare)
+        if sha1 is not None:
+            update = ET.Element('{vcard-temp:x:update}x')
+            ET.SubElement(update, '{vcard-temp:x:update}photo').text = sha1
+            stanza.append(update)
+        return stanza
+
+    async def mam_query(self, iq):
+        """Answer a XEP-0313 archive query
+
+        Sends one result message per archived message, then the iq
+        result carrying the RSM paging tokens.
+        """
+        if iq.get('type') != 'set':
+            return
+
+        query = iq.xml.find('{%s}query' % (MAM_NS,))
+        form = query.find('{jabber:x:data}x')
+        fields = await self.register_parse_form_payload(form) if form is not None else {}
+        rsm = query.find('{%s}set' % (RSM_NS,))
+        paging = {}
+        if rsm is not None:
+            for element in rsm:
+                paging[element.tag.split('}')[-1]] = element.text or ''
+
+        try:
+            limit = min(int(paging.get('max', MAM_PAGE_SIZE)), MAM_MAX_PAGE_SIZE)
+            if limit < 0:
+                raise ValueError('max must not be negative, got {}'.format(limit))
+            messages, complete = await self.archive.query(
+                iq['from'].bare,
+                with_jid=fields.get('with'),
+                start=parse_datetime(fields['start']) if fields.get('start') else None,
+                end=parse_datetime(fields['end']) if fields.get('end') else None,
+                after=paging.get('after'),
+                before=paging.get('before'),
+                limit=limit)
+        except ValueError as e:
+            logger.warning('Bad archive query from %s: %s', iq['from'], e)
+            reply = iq.reply()
+            reply.error()
+            reply['error']['type'] = 'modify'
+            reply['error']['condition'] = 'bad-request'
+            await reply.send()
+            return
+
+        for message in messages:
+            self.mam_result(iq, query.get('queryid'), message).send()
+
+        fin = ET.Element('{%s}fin' % (MAM_NS,))
+        if complete:
+            fin.set('complete', 'true')
+        rsm = ET.SubElement(fin, '{%s}set' % (RSM_NS,))
+        if messages:
+            ET.SubElement(rsm, '{%s}first' % (RSM_NS,)).text = encode_token(messages[0])
+            ET.SubElement(rsm, '{%s}last' % (RSM_NS,)).text = encode_token(messages[-1])
+        reply = iq.reply()
+        reply.set_payload(fin)
+        await reply.send()
+
+    def mam_result(self, iq, queryid, message):
+        """Wrap an archived message in a XEP-0313 result message
+        """
+        result = ET.Element('{%s}result' % (MAM_NS,), {'id': encode_token(message)})
+        if queryid is not None:
+            result.set('queryid', queryid)
+        forwarded = ET.SubElement(result, '{urn:xmpp:forward:0}forwarded')
+        ET.SubElement(forwarded, '{urn:xmpp:delay}delay', {'stamp': format_datetime(message.stamp)})
+        if message.outgoing:
+            mfrom, mto = message.jid, message.with_jid
+        else:
+            mfrom, mto = message.with_jid, message.jid
+        archived = ET.SubElement(forwarded, '{jabber:client}message',
+                                 {'from': mfrom, 'to': mto, 'type': 'chat'})
+        ET.SubElement(archived, '{jabber:client}body').text = message.body
+
+        msg = self.make_message(mto=iq['from'], mfrom=self.boundjid)
+        msg.set_payload(result)
+        return msg
 
     async def register(self, iq):
         """Logic for handling user registration to the component
@@ -114,13 +538,29 @@ class XHauntComponent(ComponentXMPP):
         :returns:
             iq: indicating success or error
         """
+        from .auth import GoogleAuthError
         data = await self.register_parse_form_payload(query_payload[0])
-        # try logging in
-        await self.users.add_account(iq['from'].bare, data['username'])
-        result = await self.get_auth_async(
-            jid=iq['from'].bare,
-            username=data['username'],
-            password=data['password'],)
+        jid = iq['from'].bare
+        accounts = self.users if self.writer is None else self.writer
+        try:
+            # don't touch the database for a jid that keeps failing
+            self.auth_breaker.check(jid)
+            await accounts.add_account(jid, data['username'])
+            # try logging in
+            result = await self.get_auth_async(
+                jid=jid,
+                username=data['username'],
+                password=data['password'],)
+        except Throttled as e:
+            logger.info('Registration for %s throttled: %s', iq['from'], e)
+            return self.wait_error(iq)
+        except GoogleAuthError as e:
+            logger.info('Registration for %s failed: %s', iq['from'], e)
+            reply = iq.reply()
+            reply.error()
+            reply['error']['type'] = 'auth'
+            reply['error']['condition'] = 'not-authorized'
+            return reply
         if result is not None:
             # schedule sending subscription
             return iq.reply()
@@ -163,8 +603,8 @@ class XHauntComponent(ComponentXMPP):
     async def register_parse_form_payload(self, x):
         results = {}
         if x.tag == '{jabber:x:data}x':
-            for field in x.getchildren():
-                for value in field.getchildren():
+            for field in x:
+                for value in field:
                     results[field.attrib['var']] = value.text
         return results
 
@@ -183,6 +623,14 @@ class XHauntComponent(ComponentXMPP):
         """
         return self.make_presence(pto=jid.bare, pfrom=self.xmpp.boundjid, ptype='subscribe')
     async def get_auth_async(self, jid, username, password=None, validation_code=None, token=None):
+        """Log in to Google in a worker process
+
+        raises Throttled without trying if jid failed to log in repeatedly
+        """
+        # hangups is slow to import, so wait until someone logs in
+        from .auth import get_auth, GoogleAuthError
+
+        self.auth_breaker.check(jid)
         with concurrent.futures.ProcessPoolExecutor() as executor:
             task = self.loop.run_in_executor(
                 executor,
@@ -193,9 +641,44 @@ class XHauntComponent(ComponentXMPP):
                 password,
                 validation_code,
                 token)
-            result = await task
+            try:
+                result = await task
+            except GoogleAuthError:
+                self.auth_breaker.failure(jid)
+                raise
+            self.auth_breaker.success(jid)
             return result
 
+    def outbound(self, stanza, operation, conversation_id=None):
+        """Schedule an operation toward Hangouts for the sender of stanza
+
+        If the sender or conversation is over its rate, stanza is
+        answered with a wait error instead.
+
+        :args:
+           stanza: the XMPP stanza that caused the operation
+           operation: coroutine function performing the Hangouts request
+           conversation_id: hangouts conversation the operation affects
+
+        :returns:
+           future of the operation's result, or None if it was throttled
+        """
+        try:
+            return self.scheduler.submit(stanza['from'].bare, operation, conversation_id)
+        except Throttled as e:
+            logger.info('Throttled %s: %s', stanza['from'], e)
+            self.wait_error(stanza).send()
+            return None
+
+    def wait_error(self, stanza):
+        """Build a wait error telling the sender of stanza to slow down
+        """
+        reply = stanza.reply()
+        reply.error()
+        reply['error']['type'] = 'wait'
+        reply['error']['condition'] = 'resource-constraint'
+        return reply
+
 
 def get_query_contents(iq):
     """Return the contents of the iq query tag
@@ -210,29 +693,15 @@ def get_query_contents(iq):
     for element in query:
         # print('gqce', element, element.tag, type(element))
         if element.tag.endswith('query'):
-            children = element.getchildren()
+            children = list(element)
             return children
 
     return []
 
 
 def main():
-    from configparser import ConfigParser
-    config = ConfigParser()
-    config.read('xhang.ini')
-
-    service_name = config['DEFAULT'].get('service_name')
-    secret = config['DEFAULT'].get('secret')
-    jabber_server = config['DEFAULT'].get('jabber_server', '127.0.0.1')
-    jabber_port = config['DEFAULT'].get('jabber_port', 5347)
-    database = config['DEFAULT'].get('database')
-
-    logging.basicConfig(level=logging.DEBUG)
-
-    xmpp = XHauntComponent(service_name, secret, jabber_server, jabber_port, database)
-
-    xmpp.connect()
-    xmpp.process()
+    from .cli import main
+    main()
 
 
 if __name__ == '__main__':
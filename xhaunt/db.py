@@ -1,10 +1,24 @@
 import aiopg
+import asyncio
+from collections import OrderedDict
 from psycopg2 import sql
 import logging
 
 logger = logging.getLogger(__name__)
 
-from hangups.user import UserID
+from .batch import BatchQueue
+from .migrations import upgrade
+
+
+def check_user_id(user_id):
+    """Raise ValueError unless user_id is a hangups UserID
+
+    hangups is imported on first use, loading it is most of the
+    gateway's startup time.
+    """
+    from hangups.user import UserID
+    if not isinstance(user_id, UserID):
+        raise ValueError('Expected type "UserID", got {}'.format(type(user_id)))
 
 
 class HauntDB:
@@ -15,10 +29,21 @@ class HauntDB:
         self.password = password
         self.host = host
         self.default_database = 'template1'
+        self._lock = None
 
     def __del__(self):
         self.close()
 
+    @property
+    def lock(self):
+        '''Lock for sharing the connection between tasks
+
+        aiopg connections can only run one query at a time.
+        '''
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
     async def connect(self):
         '''Connect to database'''
         if self.conn is None:
@@ -45,6 +70,14 @@ class HauntDB:
             self.conn.close()
             self.conn = None
 
+    async def upgrade_schema(self):
+        """Apply any pending schema migrations
+
+        returns the list of migration versions that were applied
+        """
+        await self.connect()
+        return await upgrade(self.conn)
+
     async def _does_database_exist(self):
         """Test if self.database name exists
         """
@@ -82,26 +115,21 @@ class HauntDB:
 
 class Users(HauntDB):
     async def create_table_if_needed(self):
-        await self.connect()
-        cur = await self.conn.cursor()
-        await cur.execute("""
-create table if not exists users (
-            id serial primary key,
-            jid varchar(255) unique,
-            username varchar(255),
-            token varchar(255));
-create index user_jid_index on users using hash (jid);
-""")
+        await self.upgrade_schema()
 
     async def add_account(self, jid, username, token=None):
+        """Add an account, or update the username of an existing one
+
+        The token is only replaced when one is given, so registering
+        again keeps the stored login.
+        """
         await self.connect()
         cur = await self.conn.cursor()
-        if token is None:
-            await cur.execute('insert into users ("jid", "username") values (%s %s)',
-                              (jid, username))
-        else:
-            await cur.execute('insert into users ("jid", "username", "token") values (%s, %s, %s)',
-                              (jid, username, token))
+        await cur.execute("""
+insert into users ("jid", "username", "token") values (%s, %s, %s)
+  on conflict (jid) do update
+    set username = excluded.username,
+        token = coalesce(excluded.token, users.token)""", (jid, username, token))
 
     async def find_account(self, jid):
         await self.connect()
@@ -138,22 +166,10 @@ create index user_jid_index on users using hash (jid);
 
 class Roster(HauntDB):
     async def create_table_if_needed(self):
-        await self.connect()
-        cur = await self.conn.cursor()
-        await cur.execute("""
-create table if not exists roster (
-            id serial primary key,
-            jid varchar(255) references users (jid) on delete cascade,
-            gaia_id varchar(255),
-            chat_id varchar(255)
-);
-create index roster_jid_index on roster using hash (jid);
-create index roster_user_id_index on roster (gaia_id, chat_id);
-""")
+        await self.upgrade_schema()
 
     async def add_user_id(self, jid, user_id):
-        if not isinstance(user_id, UserID):
-            raise ValueError('Expected type "UserID", got {}'.format(type(user_id)))
+        check_user_id(user_id)
 
         await self.connect()
         cur = await self.conn.cursor()
@@ -163,8 +179,7 @@ create index roster_user_id_index on roster (gaia_id, chat_id);
             logger.warn('Insert returned {} rows instead of 1'.format(cur.rowcount))
 
     async def delete_user_id(self, jid, user_id):
-        if not isinstance(user_id, UserID):
-            raise ValueError('Expected type "UserID", got {}'.format(type(user_id)))
+        check_user_id(user_id)
 
         await self.connect()
         cur = await self.conn.cursor()
@@ -178,6 +193,7 @@ create index roster_user_id_index on roster (gaia_id, chat_id);
         cur = await self.conn.cursor()
         await cur.execute('select gaia_id, chat_id from roster where jid=%s', (jid,))
 
+        from hangups.user import UserID
         for row in cur:
             yield UserID(gaia_id=row[0], chat_id=row[1])
 
@@ -200,3 +216,111 @@ create index roster_user_id_index on roster (gaia_id, chat_id);
 
         result = await cur.fetchone()
         return result[0]
+
+
+class WriteBehind(HauntDB):
+    """Buffer account and roster mutations and write them as group commits
+
+    add_account, add_user_id and delete_user_id take the same arguments
+    as the Users and Roster methods, but only queue the change and return
+    a future. Queued changes are written in a single transaction after
+    max_delay seconds or once max_items are waiting. The future resolves
+    to the number of rows the change affected; a change superseded by a
+    later one for the same account or roster entry in the same batch
+    resolves to 0.
+
+    Adding an account that already exists updates its username, and its
+    token if one was given. Roster entries for a jid without an account
+    are skipped and resolve to 0, rather than failing the whole batch.
+    """
+    def __init__(self, database, user=None, password=None, host=None,
+                 max_items=100, max_delay=0.005):
+        super(WriteBehind, self).__init__(database, user, password, host)
+        self.queue = BatchQueue(self._write_batch, max_items, max_delay)
+
+    def add_account(self, jid, username, token=None):
+        return self.queue.submit(('add_account', (jid, username, token)))
+
+    def add_user_id(self, jid, user_id):
+        check_user_id(user_id)
+
+        return self.queue.submit(('add_user_id', (jid, user_id.gaia_id, user_id.chat_id)))
+
+    def delete_user_id(self, jid, user_id):
+        check_user_id(user_id)
+
+        return self.queue.submit(('delete_user_id', (jid, user_id.gaia_id, user_id.chat_id)))
+
+    async def flush(self):
+        """Write all queued changes now"""
+        await self.queue.flush()
+
+    async def shutdown(self):
+        """Write all queued changes and close the database connection"""
+        await self.queue.close()
+        self.close()
+
+    async def _write_batch(self, items):
+        # only the last change per account or roster entry needs writing
+        accounts = OrderedDict()
+        roster = OrderedDict()
+        for i, (operation, args) in enumerate(items):
+            if operation == 'add_account':
+                accounts[args[0]] = (i, args)
+            else:
+                roster[args] = (i, operation)
+
+        results = [0] * len(items)
+        added = [(i, key) for key, (i, operation) in roster.items() if operation == 'add_user_id']
+        deleted = [(i, key) for key, (i, operation) in roster.items() if operation == 'delete_user_id']
+
+        await self.connect()
+        cur = await self.conn.cursor()
+        await cur.execute('begin')
+        try:
+            if accounts:
+                rows = [args for i, args in accounts.values()]
+                await cur.execute("""
+insert into users ("jid", "username", "token")
+  select * from unnest(%s::varchar[], %s::varchar[], %s::varchar[])
+  on conflict (jid) do update
+    set username = excluded.username,
+        token = coalesce(excluded.token, users.token)
+  returning jid""", columns(rows))
+                written = set(row[0] for row in await cur.fetchall())
+                for jid, (i, args) in accounts.items():
+                    results[i] = int(jid in written)
+
+            if deleted:
+                await cur.execute("""
+delete from roster r
+  using unnest(%s::varchar[], %s::varchar[], %s::varchar[]) as d(jid, gaia_id, chat_id)
+  where r.jid = d.jid and r.gaia_id = d.gaia_id and r.chat_id = d.chat_id
+  returning r.jid, r.gaia_id, r.chat_id""", columns(key for i, key in deleted))
+                written = set(tuple(row) for row in await cur.fetchall())
+                for i, key in deleted:
+                    results[i] = int(key in written)
+
+            if added:
+                await cur.execute("""
+insert into roster ("jid", "gaia_id", "chat_id")
+  select d.* from unnest(%s::varchar[], %s::varchar[], %s::varchar[]) as d(jid, gaia_id, chat_id)
+  where d.jid in (select jid from users)
+  on conflict do nothing
+  returning jid, gaia_id, chat_id""", columns(key for i, key in added))
+                written = set(tuple(row) for row in await cur.fetchall())
+                for i, key in added:
+                    results[i] = int(key in written)
+
+            await cur.execute('commit')
+        except Exception:
+            await cur.execute('rollback')
+            raise
+
+        return results
+
+
+def columns(rows):
+    """Transpose rows into per-column lists, for passing to unnest()
+    """
+    return [list(column) for column in zip(*rows)]
@@ -0,0 +1,141 @@
+"""Map Hangouts users and conversations to contact JIDs and back
+
+Every relayed stanza needs its addresses translated, so the mappings
+and JID parsing are kept in LRU caches and the JIDs they return are
+shared. Treat returned JIDs as read only.
+
+Users map to gaia_id@gateway. Conversation ids are escaped with
+XEP-0106 and, because nodeprep lowercases the local part, each
+uppercase letter is written as ^ followed by the lowercase letter
+(a literal ^ becomes ^^) so the id can be recovered exactly.
+"""
+from functools import lru_cache
+import sys
+
+from slixmpp.jid import JID
+
+CACHE_SIZE = 4096
+
+ESCAPE = {
+    ' ': '\\20',
+    '"': '\\22',
+    '&': '\\26',
+    "'": '\\27',
+    '/': '\\2f',
+    ':': '\\3a',
+    '<': '\\3c',
+    '>': '\\3e',
+    '@': '\\40',
+}
+UNESCAPE = {sequence: char for char, sequence in ESCAPE.items()}
+UNESCAPE['\\5c'] = '\\'
+ESCAPE_SEQUENCES = frozenset(UNESCAPE)
+CASE_MARK = '^'
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def escape_node(text):
+    """Escape text for use as the local part of a JID, per XEP-0106
+
+    A backslash is only escaped when it would otherwise be read as the
+    start of an escape sequence.
+    """
+    escaped = []
+    for i, char in enumerate(text):
+        if char == '\\' and text[i:i + 3] in ESCAPE_SEQUENCES:
+            escaped.append('\\5c')
+        else:
+            escaped.append(ESCAPE.get(char, char))
+    return ''.join(escaped)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def unescape_node(node):
+    """Reverse escape_node
+    """
+    unescaped = []
+    i = 0
+    while i < len(node):
+        sequence = node[i:i + 3]
+        if sequence in UNESCAPE:
+            unescaped.append(UNESCAPE[sequence])
+            i += 3
+        else:
+            unescaped.append(node[i])
+            i += 1
+    return ''.join(unescaped)
+
+
+def encode_case(text):
+    encoded = []
+    for char in text:
+        if char == CASE_MARK:
+            encoded.append(CASE_MARK * 2)
+        elif char != char.lower():
+            encoded.append(CASE_MARK + char.lower())
+        else:
+            encoded.append(char)
+    return ''.join(encoded)
+
+
+def decode_case(text):
+    decoded = []
+    chars = iter(text)
+    for char in chars:
+        if char == CASE_MARK:
+            char = next(chars, '')
+            decoded.append(char if char == CASE_MARK else char.upper())
+        else:
+            decoded.append(char)
+    return ''.join(decoded)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_jid(text):
+    """Return a shared JID for text, parsing each distinct string once
+    """
+    return JID(sys.intern(text))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def user_jid(user_id, domain):
+    """Return the contact JID for a hangups UserID, e.g. gaia_id@gateway
+    """
+    return parse_jid(user_id.gaia_id + '@' + domain)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def conversation_jid(conversation_id, domain):
+    """Return the contact JID for a hangups conversation id
+    """
+    return parse_jid(encode_case(escape_node(conversation_id)) + '@' + domain)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def lookup(bare, domain):
+    """Find what a contact JID on domain refers to
+
+    :args:
+       bare (str): bare JID to look up
+       domain (str): the gateway's domain
+
+    :returns:
+       UserID for a user, the conversation id string for a
+       conversation, or None if bare is not a contact on domain
+    """
+    jid = parse_jid(bare)
+    if jid.domain != domain or not jid.user:
+        return None
+    if jid.user.isdigit():
+        from hangups.user import UserID
+        gaia_id = sys.intern(jid.user)
+        return UserID(chat_id=gaia_id, gaia_id=gaia_id)
+    return sys.intern(unescape_node(decode_case(jid.user)))
+
+
+def cache_info():
+    """Return the lru_cache statistics of each mapping, by name
+    """
+    return {function.__name__: function.cache_info()
+            for function in (escape_node, unescape_node, parse_jid,
+                             user_jid, conversation_jid, lookup)}
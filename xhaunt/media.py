@@ -0,0 +1,115 @@
+"""Stream attachments from Hangouts to XEP-0363 HTTP upload slots
+
+The download from Hangouts is fed chunk by chunk into the upload PUT,
+so memory use per transfer is bounded by chunk_size no matter how big
+the attachment is.
+"""
+import asyncio
+from collections import Counter, deque, namedtuple
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TransferStats(namedtuple('TransferStats', ['source_url', 'put_url', 'bytes', 'seconds'])):
+    @property
+    def throughput(self):
+        """Bytes per second"""
+        if self.seconds <= 0:
+            return 0
+        return self.bytes / self.seconds
+
+
+class MediaRelay:
+    """Copy attachments between HTTP endpoints without buffering them
+
+    :args:
+       max_transfers (int): transfers allowed to run at once, others wait
+       chunk_size (int): bytes read from the source and written at a time
+       timeout (float): seconds allowed for a single transfer
+       history (int): number of finished transfers kept in recent
+    """
+    def __init__(self, max_transfers=4, chunk_size=64 * 1024, timeout=300, history=100):
+        self.max_transfers = max_transfers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.active = 0
+        self.recent = deque(maxlen=history)
+        self.totals = Counter()
+        self._semaphore = None
+        self._session = None
+
+    async def relay(self, source_url, put_url, size, headers=None, content_type=None):
+        """Stream the body of source_url into a PUT to put_url
+
+        The upload always declares size as its Content-Length, since
+        upload services expect the size the slot was requested for and
+        often refuse chunked uploads. A source that turns out to be a
+        different size fails the transfer.
+
+        :args:
+           source_url (str): where to download the attachment
+           put_url (str): upload slot URL
+           size (int): bytes the upload slot was requested for
+           headers (dict): extra headers the upload slot requires
+           content_type (str): content type for the upload, defaults to
+               the source's
+
+        :returns:
+           TransferStats for the finished transfer
+        """
+        import aiohttp
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_transfers)
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+
+        async with self._semaphore:
+            self.active += 1
+            start = time.monotonic()
+            transferred = 0
+            try:
+                timeout = aiohttp.ClientTimeout(total=self.timeout)
+                async with self._session.get(source_url, timeout=timeout) as source:
+                    source.raise_for_status()
+
+                    if source.content_length is not None and source.content_length != size:
+                        raise ValueError('{} is {} bytes, the upload slot is for {}'.format(
+                            source_url, source.content_length, size))
+
+                    async def chunks():
+                        nonlocal transferred
+                        async for chunk in source.content.iter_chunked(self.chunk_size):
+                            transferred += len(chunk)
+                            if transferred > size:
+                                raise ValueError('{} is larger than {} bytes'.format(source_url, size))
+                            yield chunk
+                        if transferred != size:
+                            raise ValueError('{} ended after {} of {} bytes'.format(
+                                source_url, transferred, size))
+
+                    put_headers = dict(headers or {})
+                    put_headers['Content-Type'] = content_type or source.content_type
+                    put_headers['Content-Length'] = str(size)
+                    async with self._session.put(put_url, data=chunks(), headers=put_headers,
+                                                 timeout=timeout) as response:
+                        response.raise_for_status()
+            except Exception:
+                self.totals['failures'] += 1
+                raise
+            finally:
+                self.active -= 1
+                self.totals['bytes'] += transferred
+
+        stats = TransferStats(source_url, put_url, transferred, time.monotonic() - start)
+        self.recent.append(stats)
+        self.totals['transfers'] += 1
+        logger.info('Relayed %d bytes from %s in %.2fs (%.0f bytes/s)',
+                    stats.bytes, source_url, stats.seconds, stats.throughput)
+        return stats
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
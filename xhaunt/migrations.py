@@ -0,0 +1,135 @@
+"""Versioned schema migrations for the gateway database
+
+Each migration is a (version, description, statement) tuple. upgrade()
+applies every migration newer than the version recorded in the
+schema_version table inside a single transaction, so a database is
+either fully brought up to date or left untouched.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+# key for pg_advisory_xact_lock so gateways starting at the same time
+# don't race each other through the migrations
+MIGRATION_LOCK_ID = 0x78686175
+
+MIGRATIONS = [
+    (1, 'users and roster tables', """
+create table if not exists users (
+            id serial primary key,
+            jid varchar(255) unique,
+            username varchar(255),
+            token varchar(255));
+create table if not exists roster (
+            id serial primary key,
+            jid varchar(255) references users (jid) on delete cascade,
+            gaia_id varchar(255),
+            chat_id varchar(255)
+);
+"""),
+    # users.jid is already indexed by its unique constraint, and the
+    # roster lookups by jid can use the leading column of the new unique
+    # constraint, which also gives bulk upserts an ON CONFLICT target.
+    # roster_user_id_index (gaia_id, chat_id) is not redundant, the new
+    # constraint can't serve lookups by contact alone, but no current
+    # query looks contacts up that way. Add it back when one does.
+    (2, 'replace unused indexes with roster unique constraint', """
+drop index if exists user_jid_index;
+drop index if exists roster_jid_index;
+drop index if exists roster_user_id_index;
+delete from roster a using roster b
+ where a.id > b.id
+   and a.jid = b.jid
+   and a.gaia_id = b.gaia_id
+   and a.chat_id = b.chat_id;
+alter table roster add constraint roster_jid_user_id_key unique (jid, gaia_id, chat_id);
+"""),
+    # monthly partitions are created on demand by xhaunt.archive.Archive
+    (3, 'partitioned message archive', """
+create table archive (
+            id bigserial,
+            jid varchar(255) not null references users (jid) on delete cascade,
+            with_jid varchar(255) not null,
+            stamp timestamp with time zone not null,
+            outgoing boolean not null,
+            body text,
+            primary key (stamp, id)
+) partition by range (stamp);
+create index archive_jid_stamp_index on archive (jid, stamp, id);
+create index archive_jid_with_stamp_index on archive (jid, with_jid, stamp, id);
+"""),
+    (4, 'offline delivery queue', """
+create table offline_queue (
+            id bigserial primary key,
+            target varchar(255) not null,
+            stanza text not null,
+            queued timestamp with time zone default now());
+create index offline_queue_target_index on offline_queue (target, id);
+"""),
+    (5, 'entity capabilities cache', """
+create table caps (
+            ver varchar(255) primary key,
+            info text not null);
+"""),
+]
+
+
+async def current_version(cur):
+    """Return the newest applied migration version, 0 for a new database
+    """
+    await cur.execute('select coalesce(max(version), 0) from schema_version')
+    row = await cur.fetchone()
+    return row[0]
+
+
+async def upgrade(conn, migrations=MIGRATIONS):
+    """Bring the database behind conn up to the newest schema version
+
+    :args:
+       conn: an open aiopg connection
+       migrations: list of (version, description, statement) tuples
+
+    :returns:
+       list of versions that were applied, empty if already current
+    """
+    applied = []
+    cur = await conn.cursor()
+    await cur.execute('begin')
+    try:
+        await cur.execute('select pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_ID,))
+        await cur.execute("""
+create table if not exists schema_version (
+            version integer primary key,
+            description text,
+            applied timestamp with time zone default now());
+""")
+        version = await current_version(cur)
+        for number, description, statement in sorted(migrations):
+            if number <= version:
+                continue
+            logger.info('Applying schema migration %d: %s', number, description)
+            await cur.execute(statement)
+            await cur.execute('insert into schema_version ("version", "description") values (%s, %s)',
+                              (number, description))
+            applied.append(number)
+        await cur.execute('commit')
+    except Exception:
+        await cur.execute('rollback')
+        raise
+    return applied
+
+
+async def explain_node_types(cur, query, parameters=None):
+    """Return the set of plan node types PostgreSQL picks for a query
+
+    Used to check the hot queries are served by index scans.
+    """
+    await cur.execute('explain (format json) ' + query, parameters)
+    row = await cur.fetchone()
+    node_types = set()
+    nodes = [row[0][0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        node_types.add(node['Node Type'])
+        nodes.extend(node.get('Plans', []))
+    return node_types
@@ -0,0 +1,153 @@
+"""Durable queue for stanzas whose destination is unavailable
+
+Stanzas are stored per target, a key naming where they should go, for
+example a user's bare JID while their XMPP client is offline. Appends
+are batched through BatchQueue; redelivery reads in bulk, acknowledges
+each delivered batch with a single delete, and can be throttled with a
+TokenBucket so a long backlog doesn't crowd out live traffic.
+"""
+import asyncio
+import logging
+
+from .batch import BatchQueue
+from .db import HauntDB, columns
+
+logger = logging.getLogger(__name__)
+
+
+class OfflineQueue(HauntDB):
+    def __init__(self, database, user=None, password=None, host=None,
+                 max_items=100, max_delay=0.005):
+        super(OfflineQueue, self).__init__(database, user, password, host)
+        self.queue = BatchQueue(self.append_many, max_items, max_delay)
+        self._draining = set()
+
+    def enqueue(self, target, stanza):
+        """Queue a serialized stanza for later delivery to target
+
+        :returns:
+           future set to the stanza's queue id once it is stored
+        """
+        return self.queue.submit((target, stanza))
+
+    async def append_many(self, items):
+        """Store a list of (target, stanza) tuples
+
+        :returns:
+           list of queue ids in the same order as items
+        """
+        async with self.lock:
+            await self.connect()
+            cur = await self.conn.cursor()
+            await cur.execute("""
+insert into offline_queue ("target", "stanza")
+  select * from unnest(%s::varchar[], %s::text[])
+  returning id""", columns(items))
+            return [row[0] for row in await cur.fetchall()]
+
+    async def fetch(self, target, after=0, limit=100):
+        """Return up to limit (id, stanza) tuples for target, oldest first
+        """
+        async with self.lock:
+            await self.connect()
+            cur = await self.conn.cursor()
+            await cur.execute(
+                'select id, stanza from offline_queue where target=%s and id > %s order by id limit %s',
+                (target, after, limit))
+            return [tuple(row) for row in await cur.fetchall()]
+
+    async def acknowledge(self, target, last_id):
+        """Remove every stanza for target up to and including last_id
+
+        returns the number of removed stanzas
+        """
+        async with self.lock:
+            await self.connect()
+            cur = await self.conn.cursor()
+            await cur.execute('delete from offline_queue where target=%s and id <= %s',
+                              (target, last_id))
+            return cur.rowcount
+
+    async def count(self, target=None):
+        """Count queued stanzas, for all targets or just the provided one
+        """
+        async with self.lock:
+            await self.connect()
+            cur = await self.conn.cursor()
+            if target is None:
+                await cur.execute('select count(*) from offline_queue')
+            else:
+                await cur.execute('select count(*) from offline_queue where target=%s', (target,))
+            result = await cur.fetchone()
+            return result[0]
+
+    def is_draining(self, target):
+        """Is redelivery to target in progress
+
+        Stanzas for a target being drained should be queued behind the
+        backlog instead of sent directly, to keep them in order.
+        """
+        return target in self._draining
+
+    def redeliver(self, target, send, bucket=None, batch_size=100, available=None):
+        """Hand every queued stanza for target to send, in order
+
+        Each batch is acknowledged once send has been called for all of
+        its stanzas, so an interrupted redelivery resumes from the last
+        acknowledged batch. target counts as draining from the moment
+        this is called until the queue is empty.
+
+        :args:
+           target (str): queue to drain
+           send: function called with each serialized stanza
+           bucket (TokenBucket): if provided, one token is taken per stanza
+           batch_size (int): number of stanzas read and acknowledged at once
+           available: if provided, function returning whether target can
+               still receive stanzas. Redelivery stops, leaving the rest
+               queued, once it returns False.
+
+        :returns:
+           future set to the number of stanzas redelivered, 0 if target
+           is already being redelivered
+        """
+        if target in self._draining:
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(0)
+            return future
+
+        self._draining.add(target)
+        return asyncio.ensure_future(self._redeliver(target, send, bucket, batch_size, available))
+
+    async def _redeliver(self, target, send, bucket, batch_size, available):
+        delivered = 0
+        try:
+            while True:
+                rows = await self.fetch(target, limit=batch_size)
+                if not rows:
+                    # stanzas still waiting to be appended mustn't be skipped
+                    if not len(self.queue) and not self.queue.writing:
+                        break
+                    await self.queue.flush()
+                    continue
+
+                sent = 0
+                for queue_id, stanza in rows:
+                    if bucket is not None:
+                        await bucket.wait()
+                    if available is not None and not available():
+                        break
+                    send(stanza)
+                    sent += 1
+
+                if sent:
+                    await self.acknowledge(target, rows[sent - 1][0])
+                    delivered += sent
+                if sent < len(rows):
+                    logger.info('%s went away, leaving %d stanzas queued', target, len(rows) - sent)
+                    break
+        finally:
+            self._draining.discard(target)
+
+        if delivered:
+            logger.info('Redelivered %d queued stanzas to %s', delivered, target)
+        return delivered
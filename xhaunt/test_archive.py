@@ -0,0 +1,195 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import patch
+
+from xml.etree import ElementTree as ET
+from slixmpp.stanza.iq import Iq
+from slixmpp.stanza.message import Message
+
+from .archive import Archive, ArchivedMessage, encode_token, decode_token
+from .component import XHauntComponent
+from .db import Users
+from .test_component import async_test, get_mock_coroutine
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        self.database = 'xhangtest_archive'
+        self.jid = 'test@example.org'
+        self.contact = '1234567890@hangouts.example.net'
+
+    @async_test
+    async def test_keyset_pages(self):
+        users = Users(database=self.database)
+        archive = Archive(database=self.database, max_items=10, max_delay=0.01)
+        try:
+            await users._create_database_if_needed()
+            await users.create_table_if_needed()
+            await users.add_account(self.jid, 'hangouts1', 'pw1')
+
+            # a message every ten days spanning several monthly partitions
+            start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+            futures = [
+                archive.archive_message(self.jid, self.contact, 'message {}'.format(i), i % 2 == 0,
+                                        stamp=start + timedelta(days=10 * i))
+                for i in range(25)]
+            unknown = archive.archive_message('stranger@example.org', self.contact, 'hi', True, stamp=start)
+            ids = await asyncio.gather(*futures)
+            self.assertNotIn(None, ids)
+            self.assertIsNone(await unknown)
+
+            # page forward through everything
+            bodies = []
+            after = None
+            complete = False
+            while not complete:
+                messages, complete = await archive.query(self.jid, after=after, limit=10)
+                bodies.extend(message.body for message in messages)
+                after = encode_token(messages[-1])
+            self.assertEqual(bodies, ['message {}'.format(i) for i in range(25)])
+
+            # last page, then the page before it
+            messages, complete = await archive.query(self.jid, before='', limit=10)
+            self.assertFalse(complete)
+            self.assertEqual(messages[0].body, 'message 15')
+            self.assertEqual(messages[-1].body, 'message 24')
+            messages, complete = await archive.query(self.jid, before=encode_token(messages[0]), limit=10)
+            self.assertEqual(messages[0].body, 'message 5')
+
+            # time range and contact filters
+            messages, complete = await archive.query(
+                self.jid, start=datetime(2026, 3, 1, tzinfo=timezone.utc),
+                end=datetime(2026, 3, 31, tzinfo=timezone.utc))
+            self.assertTrue(complete)
+            self.assertEqual([m.body for m in messages], ['message 6', 'message 7', 'message 8'])
+            messages, complete = await archive.query(self.jid, with_jid='other@hangouts.example.net')
+            self.assertEqual(messages, [])
+
+            # drop January and February
+            dropped = await archive.prune(datetime(2026, 3, 1, tzinfo=timezone.utc))
+            self.assertEqual(dropped, ['archive_y2026m01', 'archive_y2026m02'])
+            messages, complete = await archive.query(self.jid, limit=1)
+            self.assertEqual(messages[0].body, 'message 6')
+
+            # the batch writer and readers share one connection
+            results = await asyncio.gather(
+                archive.query(self.jid, limit=1),
+                archive.archive_message(self.jid, self.contact, 'late', True,
+                                        stamp=start + timedelta(days=300)),
+                archive.query(self.jid, limit=1))
+            self.assertEqual(results[0], results[2])
+            self.assertIsNotNone(results[1])
+        finally:
+            await archive.queue.close()
+            users.close()
+            archive.close()
+            await users._drop_database()
+
+    def test_token(self):
+        stamp = datetime(2026, 10, 19, 12, 30, 15, 123456, tzinfo=timezone.utc)
+        message = ArchivedMessage(42, self.jid, self.contact, stamp, True, 'hi')
+        self.assertEqual(decode_token(encode_token(message)), (stamp, 42))
+        for token in ['garbage', '99999999999999999999-1', '1-99999999999999999999']:
+            with self.assertRaises(ValueError):
+                decode_token(token)
+
+
+class TestMessageArchiveQuery(TestCase):
+    def setUp(self):
+        self.xmpp = XHauntComponent('hangouts.example.net', 'secret', '127.0.0.1', 1234, 'testxhang')
+
+    @async_test
+    async def test_mam_query(self):
+        stamp = datetime(2026, 10, 19, tzinfo=timezone.utc)
+        messages = [
+            ArchivedMessage(1, 'user@example.com', '1@hangouts.example.net', stamp, True, 'hello'),
+            ArchivedMessage(2, 'user@example.com', '1@hangouts.example.net', stamp, False, 'hi'),
+        ]
+        with patch.object(self.xmpp.archive, 'query',
+                          wraps=get_mock_coroutine(return_value=(messages, True))) as query, \
+             patch.object(Message, 'send') as message_send, \
+             patch.object(Iq, 'send', wraps=get_mock_coroutine(return_value=None)) as iq_send:
+            iq = Iq(stype='set')
+            iq['from'] = 'user@example.com/asdf'
+            iq['to'] = 'hangouts.example.net'
+            iq.set_payload(ET.fromstring('''
+<query xmlns="urn:xmpp:mam:2" queryid="q1">
+  <x xmlns="jabber:x:data" type="submit">
+    <field var="FORM_TYPE" type="hidden"><value>urn:xmpp:mam:2</value></field>
+    <field var="with"><value>1@hangouts.example.net</value></field>
+  </x>
+  <set xmlns="http://jabber.org/protocol/rsm">
+    <max>10</max>
+    <after>5-1</after>
+  </set>
+</query>'''))
+            await self.xmpp.mam_query(iq)
+
+            query.assert_called_with(
+                'user@example.com', with_jid='1@hangouts.example.net',
+                start=None, end=None, after='5-1', before=None, limit=10)
+            self.assertEqual(message_send.call_count, 2)
+            iq_send.assert_called_with()
+
+    @async_test
+    async def test_mam_query_negative_max(self):
+        sent = []
+
+        async def send(self, *args, **kwargs):
+            sent.append(self)
+
+        with patch.object(self.xmpp.archive, 'query') as query, \
+             patch.object(Iq, 'send', new=send):
+            iq = Iq(stype='set')
+            iq['from'] = 'user@example.com/asdf'
+            iq['to'] = 'hangouts.example.net'
+            iq.set_payload(ET.fromstring('''
+<query xmlns="urn:xmpp:mam:2">
+  <set xmlns="http://jabber.org/protocol/rsm"><max>-5</max></set>
+</query>'''))
+            await self.xmpp.mam_query(iq)
+
+        self.assertFalse(query.called)
+        self.assertEqual(sent[0]['type'], 'error')
+        self.assertEqual(sent[0]['error']['condition'], 'bad-request')
+
+    @async_test
+    async def test_mam_query_bad_token(self):
+        sent = []
+
+        async def send(self, *args, **kwargs):
+            sent.append(self)
+
+        # decoding the token fails before the database is touched
+        with patch.object(self.xmpp.archive, 'connect') as connect, \
+             patch.object(Iq, 'send', new=send):
+            for token in ['99999999999999999999-1', '1-99999999999999999999']:
+                iq = Iq(stype='set')
+                iq['from'] = 'user@example.com/asdf'
+                iq['to'] = 'hangouts.example.net'
+                iq.set_payload(ET.fromstring('''
+<query xmlns="urn:xmpp:mam:2">
+  <set xmlns="http://jabber.org/protocol/rsm"><after>{}</after></set>
+</query>'''.format(token)))
+                await self.xmpp.mam_query(iq)
+
+        self.assertFalse(connect.called)
+        self.assertEqual(len(sent), 2)
+        for reply in sent:
+            self.assertEqual(reply['type'], 'error')
+            self.assertEqual(reply['error']['condition'], 'bad-request')
+
+    def test_mam_result(self):
+        iq = Iq(stype='set')
+        iq['from'] = 'user@example.com/asdf'
+        stamp = datetime(2026, 10, 19, tzinfo=timezone.utc)
+        message = ArchivedMessage(2, 'user@example.com', '1@hangouts.example.net', stamp, False, 'hi')
+
+        msg = self.xmpp.mam_result(iq, 'q1', message)
+        result = msg.xml.find('{urn:xmpp:mam:2}result')
+        self.assertEqual(result.get('queryid'), 'q1')
+        self.assertEqual(result.get('id'), encode_token(message))
+        archived = result.find('{urn:xmpp:forward:0}forwarded/{jabber:client}message')
+        self.assertEqual(archived.get('from'), '1@hangouts.example.net')
+        self.assertEqual(archived.find('{jabber:client}body').text, 'hi')
@@ -0,0 +1,145 @@
+import asyncio
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from slixmpp.jid import JID
+from slixmpp.stanza.iq import Iq
+from slixmpp.stanza.presence import Presence
+
+from .avatar import AvatarCache
+from .component import XHauntComponent
+from .test_component import async_test, get_mock_coroutine
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64
+
+
+class AvatarServer:
+    """Local stand in for the Hangouts avatar host"""
+    def __init__(self):
+        self.requests = 0
+        app = web.Application()
+        app.router.add_get('/{name}', self.handle)
+        self.server = TestServer(app)
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(0.01)
+        if request.match_info['name'] == 'missing.png':
+            raise web.HTTPNotFound()
+        if request.match_info['name'] == 'empty.png':
+            return web.Response(body=b'', content_type='image/png')
+        if request.match_info['name'] == 'huge.png':
+            # chunked, so there's no Content-Length to check up front
+            response = web.StreamResponse(headers={'Content-Type': 'image/png'})
+            await response.prepare(request)
+            for i in range(4):
+                await response.write(PNG)
+            await response.write_eof()
+            return response
+        return web.Response(body=PNG, content_type='image/png')
+
+    def url(self, name):
+        return str(self.server.make_url('/' + name))
+
+
+class TestAvatarCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='xhaunt-avatar')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @async_test
+    async def test_fetch(self):
+        server = AvatarServer()
+        await server.server.start_server()
+        cache = AvatarCache(self.directory, max_urls=1, max_bytes=3 * len(PNG))
+        try:
+            # concurrent requests share one download
+            results = await asyncio.gather(*[cache.fetch(server.url('a.png')) for i in range(5)])
+            sha1 = hashlib.sha1(PNG).hexdigest()
+            self.assertEqual(results, [sha1] * 5)
+            self.assertEqual(server.requests, 1)
+
+            # cached
+            self.assertEqual(await cache.fetch(server.url('a.png')), sha1)
+            self.assertEqual(server.requests, 1)
+
+            # same image under another url is stored once, and evicts a.png's url
+            self.assertEqual(await cache.fetch(server.url('b.png')), sha1)
+            self.assertEqual(list(cache.urls), [server.url('b.png')])
+            self.assertEqual(server.requests, 2)
+
+            mime_type, data = cache.read_base64(sha1)
+            self.assertEqual(mime_type, 'image/png')
+            self.assertEqual(base64.b64decode(data), PNG)
+
+            with self.assertRaises(Exception):
+                await cache.fetch(server.url('missing.png'))
+            self.assertEqual(cache._fetching, {})
+
+            # nothing stored that vcard_query couldn't serve
+            with self.assertRaises(ValueError):
+                await cache.fetch(server.url('empty.png'))
+            with self.assertRaises(ValueError):
+                await cache.fetch(server.url('huge.png'))
+            self.assertEqual(os.listdir(self.directory), [sha1[:2]])
+        finally:
+            await cache.close()
+            await server.server.close()
+
+
+class TestComponentAvatar(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='xhaunt-avatar')
+        self.contact = JID('1234567890@hangouts.example.net')
+        self.sha1 = hashlib.sha1(PNG).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_component(self):
+        xmpp = XHauntComponent('hangouts.example.net', 'secret', '127.0.0.1', 1234, 'testxhang',
+                               avatar_directory=self.directory)
+        xmpp.avatars._write(self.sha1, PNG)
+        return xmpp
+
+    @async_test
+    async def test_set_contact_avatar(self):
+        xmpp = self.make_component()
+        with patch.object(xmpp.avatars, 'fetch', wraps=get_mock_coroutine(return_value=self.sha1)) as fetch:
+            await xmpp.set_contact_avatar(self.contact, 'http://example.com/a.png')
+            fetch.assert_called_with('http://example.com/a.png')
+
+        presence = Presence()
+        presence['from'] = self.contact
+        presence = xmpp._add_photo_hash(presence)
+        photo = presence.xml.find('{vcard-temp:x:update}x/{vcard-temp:x:update}photo')
+        self.assertEqual(photo.text, self.sha1)
+
+    @async_test
+    async def test_vcard_query(self):
+        xmpp = self.make_component()
+        xmpp.contact_avatars[self.contact.bare] = self.sha1
+        sent = []
+
+        async def send(self, *args, **kwargs):
+            sent.append(self)
+
+        with patch.object(Iq, 'send', new=send):
+            iq = Iq(stype='get')
+            iq['from'] = 'user@example.com/asdf'
+            iq['to'] = self.contact
+            iq.set_query('vcard-temp')
+            await xmpp.vcard_query(iq)
+
+        self.assertEqual(len(sent), 1)
+        binval = sent[0].xml.find('{vcard-temp}vCard/{vcard-temp}PHOTO/{vcard-temp}BINVAL')
+        self.assertEqual(base64.b64decode(binval.text), PNG)
@@ -0,0 +1,73 @@
+import asyncio
+import gc
+from unittest import TestCase
+
+from .batch import BatchQueue
+from .test_component import async_test
+
+
+class RecordingWriter:
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+
+    async def __call__(self, items):
+        self.batches.append(items)
+        if self.fail:
+            raise RuntimeError('write failed')
+        return [item * 2 for item in items]
+
+
+class TestBatchQueue(TestCase):
+    @async_test
+    async def test_flush_after_delay(self):
+        writer = RecordingWriter()
+        queue = BatchQueue(writer, max_items=100, max_delay=0.01)
+        futures = [queue.submit(i) for i in range(5)]
+        self.assertEqual(writer.batches, [])
+
+        results = await asyncio.gather(*futures)
+        self.assertEqual(results, [0, 2, 4, 6, 8])
+        self.assertEqual(writer.batches, [[0, 1, 2, 3, 4]])
+
+    @async_test
+    async def test_flush_when_full(self):
+        writer = RecordingWriter()
+        queue = BatchQueue(writer, max_items=3, max_delay=60)
+        futures = [queue.submit(i) for i in range(7)]
+
+        results = await asyncio.gather(*futures[:6])
+        self.assertEqual(results, [0, 2, 4, 6, 8, 10])
+        self.assertEqual(writer.batches, [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(len(queue), 1)
+
+        await queue.close()
+        self.assertEqual(futures[6].result(), 12)
+        self.assertEqual(writer.batches[-1], [6])
+
+    @async_test
+    async def test_failed_batch(self):
+        writer = RecordingWriter(fail=True)
+        queue = BatchQueue(writer, max_items=2, max_delay=60)
+        futures = [queue.submit(i) for i in range(2)]
+
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                await future
+
+    @async_test
+    async def test_failed_batch_dropped_futures(self):
+        unhandled = []
+        asyncio.get_event_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+        writer = RecordingWriter(fail=True)
+        queue = BatchQueue(writer, max_items=100, max_delay=60)
+        for i in range(3):
+            queue.submit(i)
+
+        with self.assertLogs('xhaunt.batch', 'ERROR') as logs:
+            await queue.close()
+        self.assertEqual(len(logs.output), 1)
+        # the captured record holds the futures through the traceback
+        del logs
+        gc.collect()
+        self.assertEqual(unhandled, [])
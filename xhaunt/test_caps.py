@@ -0,0 +1,111 @@
+import inspect
+from unittest import TestCase
+from unittest.mock import patch
+
+from slixmpp.jid import JID
+from slixmpp.plugins.xep_0030.stanza import DiscoInfo
+from slixmpp.stanza.presence import Presence
+
+from .caps import CapsCache
+from .component import XHauntComponent, CAPS_NODE
+from .db import Users
+from .test_component import async_test, get_mock_coroutine
+
+
+def make_client_info():
+    info = DiscoInfo()
+    info.add_identity('client', 'phone', 'Conversations')
+    info.add_feature('http://jabber.org/protocol/disco#info')
+    info.add_feature('urn:xmpp:receipts')
+    return info
+
+
+class TestCapsCache(TestCase):
+    def setUp(self):
+        self.database = 'xhangtest_caps'
+
+    @async_test
+    async def test_persistence(self):
+        users = Users(database=self.database)
+        cache = CapsCache(database=self.database)
+        restarted = CapsCache(database=self.database)
+        try:
+            await users._create_database_if_needed()
+            await users.create_table_if_needed()
+
+            info = make_client_info()
+            self.assertTrue(cache.store('ver1', info))
+            self.assertIs(cache.retrieve('ver1'), info)
+            await cache.queue.close()
+
+            self.assertEqual(await restarted.load(), 1)
+            self.assertEqual(set(restarted.retrieve('ver1')['features']), set(info['features']))
+            self.assertIsNone(restarted.retrieve('ver2'))
+        finally:
+            users.close()
+            cache.close()
+            restarted.close()
+            await users._drop_database()
+
+
+async def resolve(result):
+    """Await slixmpp API results, which are futures since slixmpp 1.8"""
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+class TestComponentCaps(TestCase):
+    def make_component(self):
+        return XHauntComponent('hangouts.example.net', 'secret', '127.0.0.1', 1234, 'testxhang')
+
+    @async_test
+    async def test_contact_caps(self):
+        xmpp = self.make_component()
+        contact = JID('1234567890@hangouts.example.net')
+        info = await resolve(xmpp.plugin['xep_0030'].api['get_info'](contact, None, None, None))
+        self.assertIn('http://jabber.org/protocol/caps', info['features'])
+        node = '%s#%s' % (CAPS_NODE, xmpp.contact_ver)
+        self.assertIs(await resolve(xmpp.plugin['xep_0030'].api['get_info'](contact, node, None, None)),
+                      info)
+
+        presence = Presence()
+        presence['from'] = contact
+        presence['to'] = 'user@example.com'
+        presence = await resolve(xmpp.plugin['xep_0115']._filter_add_caps(presence))
+        self.assertEqual(presence['caps']['ver'], xmpp.contact_ver)
+        self.assertEqual(presence['caps']['node'], CAPS_NODE)
+
+    @async_test
+    async def test_gateway_caps(self):
+        xmpp = self.make_component()
+        with patch.object(xmpp.caps_cache, 'load', wraps=get_mock_coroutine(return_value=0)) as load:
+            await xmpp.start(None)
+            self.assertTrue(load.called)
+        self.assertEqual(await resolve(xmpp.plugin['xep_0115'].get_verstring(xmpp.boundjid)),
+                         xmpp.gateway_ver)
+        self.assertNotEqual(xmpp.gateway_ver, xmpp.contact_ver)
+
+    @async_test
+    async def test_client_caps_persisted(self):
+        xmpp = self.make_component()
+        caps = xmpp.plugin['xep_0115']
+        info = make_client_info()
+        ver = caps.generate_verstring(info, 'sha-1')
+
+        async def get_info(*args, **kwargs):
+            return info
+
+        presence = Presence()
+        presence['from'] = 'user@example.com/phone'
+        presence['caps']['hash'] = 'sha-1'
+        presence['caps']['node'] = 'http://conversations.im'
+        presence['caps']['ver'] = ver
+
+        with patch.object(xmpp.plugin['xep_0030'], 'get_info', wraps=get_info), \
+             patch.object(xmpp.caps_cache.queue, 'submit') as submit:
+            await caps._process_caps(presence)
+
+        self.assertEqual(await resolve(caps.get_verstring('user@example.com/phone')), ver)
+        self.assertIs(xmpp.caps_cache.retrieve(ver), info)
+        self.assertEqual(submit.call_args[0][0][0], ver)
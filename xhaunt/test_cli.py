@@ -0,0 +1,110 @@
+import asyncio
+from configparser import ConfigParser
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from . import cli
+from .caps import CapsCache
+from .component import XHauntComponent
+from .test_component import get_mock_coroutine
+
+
+class TestCli(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='xhaunt-cli')
+        self.config = os.path.join(self.directory, 'xhang.ini')
+        with open(self.config, 'wt') as outstream:
+            outstream.write('[DEFAULT]\nservice_name = hangouts.example.net\nlog_level = warning\n')
+        self.root_handlers = logging.getLogger().handlers
+        self.root_level = logging.getLogger().level
+
+    def tearDown(self):
+        logging.getLogger().handlers = self.root_handlers
+        logging.getLogger().setLevel(self.root_level)
+        shutil.rmtree(self.directory)
+
+    def test_main(self):
+        log_file = os.path.join(self.directory, 'xhaunt.log')
+
+        def run(defaults, exit_on_connect):
+            self.assertEqual(defaults['service_name'], 'hangouts.example.net')
+            self.assertTrue(exit_on_connect)
+            self.assertEqual(logging.getLogger().level, logging.INFO)
+            logging.getLogger('xhaunt').info('queued')
+
+        with patch.object(cli, 'run', new=run):
+            cli.main(['-c', self.config, '-l', 'info', '--log-file', log_file, '--exit-on-connect'])
+
+        # stopping the listener wrote out the queued record
+        with open(log_file, 'rt') as instream:
+            self.assertIn('INFO xhaunt: queued', instream.read())
+
+    def test_config_log_level(self):
+        with patch.object(cli, 'run') as run:
+            cli.main(['-c', self.config, '--log-file', os.path.join(self.directory, 'log')])
+        self.assertEqual(logging.getLogger().level, logging.WARNING)
+        self.assertTrue(run.called)
+
+    def test_invalid_config_log_level(self):
+        with open(self.config, 'wt') as outstream:
+            outstream.write('[DEFAULT]\nlog_level = verbose\n')
+        with patch.object(cli, 'run') as run, patch('sys.stderr'), self.assertRaises(SystemExit):
+            cli.main(['-c', self.config])
+        self.assertFalse(run.called)
+        self.assertEqual(logging.getLogger().handlers, self.root_handlers)
+
+    def run_gateway(self, exit_on_connect, connect):
+        """Call the real run, with connect replaced
+
+        :returns:
+           list of events the queues were flushed for
+        """
+        config = ConfigParser()
+        config.read_string('[DEFAULT]\nservice_name = hangouts.example.net\navatar_directory = {}\n'.format(
+            self.directory))
+        flushed = []
+
+        async def flush_queues(xmpp):
+            await asyncio.sleep(0)
+            flushed.append(True)
+
+        with patch.object(XHauntComponent, 'connect', new=connect), \
+             patch.object(XHauntComponent, '_flush_queues', new=flush_queues), \
+             patch.object(CapsCache, 'load', new=get_mock_coroutine(return_value=None)):
+            cli.run(config['DEFAULT'], exit_on_connect=exit_on_connect)
+        return flushed
+
+    def test_run(self):
+        # connecting is faked by starting the session
+        def connect(xmpp, *args, **kwargs):
+            xmpp.event('session_start')
+
+        with self.assertLogs('xhaunt.cli', logging.INFO) as logs:
+            self.assertEqual(self.run_gateway(True, connect), [True])
+        self.assertIn('Startup:', logs.output[0])
+
+    def test_run_until_signal(self):
+        def connect(xmpp, *args, **kwargs):
+            xmpp.loop.call_soon(os.kill, os.getpid(), signal.SIGTERM)
+
+        self.assertEqual(self.run_gateway(False, connect), [True])
+
+    def test_missing_config(self):
+        with patch('sys.stderr'), self.assertRaises(SystemExit):
+            cli.main(['-c', os.path.join(self.directory, 'missing.ini')])
+
+    def test_lazy_imports(self):
+        # hangups and aiohttp are loaded when first needed, not at startup
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, xhaunt.component; '
+            'print(sorted(m for m in ("hangups", "aiohttp") if m in sys.modules))'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.strip(), b'[]')
@@ -0,0 +1,123 @@
+import asyncio
+from unittest import TestCase
+from unittest.mock import patch
+
+from slixmpp.stanza.message import Message
+from xml.etree import ElementTree as ET
+
+from .coalesce import CHATSTATES_NS, ChatStateCoalescer, Coalescer, chat_state
+from .component import XHauntComponent
+from .test_component import async_test
+
+KEY = ('user@example.com', '1234@hangouts.example.net')
+
+
+class TestCoalescer(TestCase):
+    @async_test
+    async def test_latest_wins(self):
+        sent = []
+        coalescer = Coalescer(lambda key, value: sent.append((key, value)), window=0.01)
+        for i in range(10):
+            coalescer.put(KEY, i)
+        coalescer.put('other', 'a')
+        self.assertEqual(len(coalescer), 2)
+
+        await asyncio.sleep(0.02)
+        self.assertEqual(dict(sent), {KEY: 9, 'other': 'a'})
+        self.assertEqual(coalescer.stats['coalesced'], 9)
+        self.assertEqual(coalescer.stats['sent'], 2)
+
+        coalescer.put(KEY, 10)
+        coalescer.flush()
+        self.assertEqual(sent[-1], (KEY, 10))
+        self.assertEqual(len(coalescer), 0)
+
+    @async_test
+    async def test_chat_states(self):
+        sent = []
+        states = ChatStateCoalescer(lambda key, state: sent.append(state), window=0.01)
+
+        # the message overtakes the composing announcing it
+        states.put(KEY, 'composing')
+        states.message_sent(KEY)
+        await asyncio.sleep(0.02)
+        self.assertEqual(sent, [])
+
+        # already active after the message
+        states.put(KEY, 'active')
+        states.put(KEY, 'composing')
+        states.put(KEY, 'paused')
+        await asyncio.sleep(0.02)
+        self.assertEqual(sent, ['paused'])
+
+        # flipping back to the state last sent sends nothing
+        states.put(KEY, 'composing')
+        states.put(KEY, 'paused')
+        await asyncio.sleep(0.02)
+        self.assertEqual(sent, ['paused'])
+        self.assertEqual(states.stats['unchanged'], 2)
+
+
+class TestComponentCoalesce(TestCase):
+    def setUp(self):
+        self.xmpp = XHauntComponent('hangouts.example.net', 'secret', '127.0.0.1', 1234, 'testxhang')
+        for coalescer in (self.xmpp.user_states, self.xmpp.contact_states, self.xmpp.receipts):
+            coalescer.window = 0.01
+        self.events = []
+        self.xmpp.add_event_handler('hangouts_chat_state', self.events.append)
+        self.xmpp.add_event_handler('hangouts_watermark', self.events.append)
+
+    def make_message(self, state=None, body=None, receipt=None):
+        msg = Message(stype='chat')
+        msg['from'] = 'user@example.com/asdf'
+        msg['to'] = '1234@hangouts.example.net'
+        if body is not None:
+            msg['body'] = body
+        if state is not None:
+            msg.append(ET.Element('{%s}%s' % (CHATSTATES_NS, state)))
+        if receipt is not None:
+            msg.append(ET.Element('{urn:xmpp:receipts}received', {'id': receipt}))
+        return msg
+
+    @async_test
+    async def test_user_chat_states(self):
+        with patch.object(Message, 'send'), \
+             patch.object(self.xmpp, 'archive_message'):
+            self.assertEqual(chat_state(self.make_message('paused')), 'paused')
+            for state in ['composing', 'paused', 'composing']:
+                self.xmpp.message(self.make_message(state))
+            self.xmpp.message(self.make_message('active', body='hi'))
+            await asyncio.sleep(0.02)
+            self.assertEqual(self.events, [])
+
+            self.xmpp.message(self.make_message('composing'))
+            await asyncio.sleep(0.02)
+            self.assertEqual(self.events, [{
+                'jid': 'user@example.com',
+                'contact': '1234@hangouts.example.net',
+                'state': 'composing'}])
+
+    @async_test
+    async def test_receipts(self):
+        for i in range(5):
+            self.xmpp.message(self.make_message(receipt='msg{}'.format(i)))
+        await asyncio.sleep(0.02)
+        self.assertEqual(self.events, [{
+            'jid': 'user@example.com',
+            'contact': '1234@hangouts.example.net',
+            'id': 'msg4'}])
+
+    @async_test
+    async def test_contact_chat_states(self):
+        sent = []
+        self.xmpp.available['user@example.com'] = {'asdf'}
+        with patch.object(Message, 'send', new=lambda self: sent.append(self)):
+            self.xmpp.relay_chat_state('user@example.com', '1234@hangouts.example.net', 'composing')
+            self.xmpp.relay_chat_state('user@example.com', '1234@hangouts.example.net', 'paused')
+            # nobody online to tell
+            self.xmpp.relay_chat_state('other@example.com', '1234@hangouts.example.net', 'composing')
+            await asyncio.sleep(0.02)
+
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]['to'], 'user@example.com')
+        self.assertEqual(chat_state(sent[0]), 'paused')
@@ -49,7 +49,7 @@ class TestXHang(TestCase):
             iq,
             username=username, password=password)
         query_payload = form.xml.find('{jabber:iq:register}query')
-        query_children = query_payload.getchildren()
+        query_children = list(query_payload)
         data = await xmpp.register_parse_form_payload(query_children[0])
         self.assertEqual(username, data['username'])
         self.assertEqual(password, data['password'])
@@ -270,3 +270,19 @@ class TestUtils(TestCase):
         contents = get_query_contents(iq)
         self.assertEqual(len(contents), 1)
         self.assertEqual(contents[0].tag, '{jabber:x:register}remove')
+
+
+class TestShutdown(TestCase):
+    @async_test
+    async def test_disconnected_event(self):
+        xmpp = XHauntComponent('server', 'secret', '127.0.0.1', 1234, 'testxhang')
+        xmpp.loop = asyncio.get_event_loop()
+        closed = []
+
+        async def close():
+            closed.append(True)
+
+        with patch.object(xmpp.media, 'close', new=close):
+            xmpp.event('disconnected')
+            await asyncio.sleep(0.01)
+        self.assertEqual(closed, [True])
@@ -1,7 +1,7 @@
 from unittest import TestCase
 
 from .test_component import async_test
-from .db import Users, Roster
+from .db import Users, Roster, WriteBehind
 
 from hangups.user import UserID
 
@@ -40,6 +40,12 @@ class TestUser(TestCase):
             count = await users.count()
             self.assertEqual(count, 2)
 
+            # adding again updates the username and keeps the token
+            await users.add_account('other@example.org', 'other2')
+            self.assertEqual(await users.count(), 2)
+            data = await users.find_account('other@example.org')
+            self.assertEqual(data, {'username': 'other2', 'password': password})
+
             # find accounts
             data = await users.find_account(test_user)
             self.assertEqual(data['username'], legacy_user)
@@ -76,3 +82,53 @@ class TestUser(TestCase):
             users.close()
             roster.close()
             await users._drop_database()
+
+
+class TestWriteBehind(TestCase):
+    def setUp(self):
+        self.database = 'xhangtest_writebehind'
+
+    @async_test
+    async def test_group_commit(self):
+        users = Users(database=self.database)
+        roster = Roster(database=self.database)
+        writer = WriteBehind(database=self.database, max_items=100, max_delay=0.01)
+        try:
+            test_user = 'test@example.org'
+            roster1 = UserID(gaia_id="1234567890", chat_id="1234567890")
+            roster2 = UserID(gaia_id="0987654321", chat_id="0987654321")
+
+            await users._create_database_if_needed()
+            await users.create_table_if_needed()
+
+            account = writer.add_account(test_user, 'hangouts1', 'pw1')
+            added = [writer.add_user_id(test_user, roster1),
+                     writer.add_user_id(test_user, roster2)]
+            # superseded by the later delete in the same batch
+            superseded = writer.add_user_id(test_user, roster2)
+            deleted = writer.delete_user_id(test_user, roster2)
+            # no account, skipped without failing the rest of the batch
+            stranger = writer.add_user_id('stranger@example.org', roster1)
+
+            self.assertEqual(await account, 1)
+            self.assertEqual(await added[0], 1)
+            self.assertEqual(await added[1], 0)
+            self.assertEqual(await superseded, 0)
+            # roster2 never reached the database
+            self.assertEqual(await deleted, 0)
+            self.assertEqual(await stranger, 0)
+
+            self.assertEqual(await roster.count(test_user), 1)
+
+            # updating an account keeps the token
+            writer.add_account(test_user, 'hangouts2')
+            duplicate = writer.add_user_id(test_user, roster1)
+            await writer.shutdown()
+            self.assertEqual(duplicate.result(), 0)
+            data = await users.find_account(test_user)
+            self.assertEqual(data, {'username': 'hangouts2', 'password': 'pw1'})
+        finally:
+            users.close()
+            roster.close()
+            writer.close()
+            await users._drop_database()
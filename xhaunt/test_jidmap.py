@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from hangups.user import UserID
+from slixmpp.jid import JID
+
+from . import jidmap
+from .component import XHauntComponent
+
+DOMAIN = 'hangouts.example.net'
+
+
+class TestEscaping(TestCase):
+    def test_xep_0106_examples(self):
+        examples = [
+            ('space cadet', 'space\\20cadet'),
+            ('call me "ishmael"', 'call\\20me\\20\\22ishmael\\22'),
+            ('at&t guy', 'at\\26t\\20guy'),
+            ("d'artagnan", 'd\\27artagnan'),
+            ('/.fanboy', '\\2f.fanboy'),
+            ('::foo::', '\\3a\\3afoo\\3a\\3a'),
+            ('<foo>', '\\3cfoo\\3e'),
+            ('user@host', 'user\\40host'),
+            ('c:\\net', 'c\\3a\\net'),
+            ('c:\\\\net', 'c\\3a\\\\net'),
+            ('c:\\cool stuff', 'c\\3a\\cool\\20stuff'),
+            ('c:\\5commas', 'c\\3a\\5c5commas'),
+        ]
+        for text, escaped in examples:
+            self.assertEqual(jidmap.escape_node(text), escaped)
+            self.assertEqual(jidmap.unescape_node(escaped), text)
+
+
+class TestMapping(TestCase):
+    def test_user(self):
+        user_id = UserID(chat_id='108378390345698342340', gaia_id='108378390345698342340')
+        jid = jidmap.user_jid(user_id, DOMAIN)
+        self.assertEqual(jid, JID('108378390345698342340@hangouts.example.net'))
+        self.assertIs(jidmap.user_jid(user_id, DOMAIN), jid)
+        self.assertEqual(jidmap.lookup(jid.bare, DOMAIN), user_id)
+
+    def test_conversation(self):
+        for conversation_id in ['UgwNotReallyAnId4AaABAQ', 'Ug^x/y@z A', 'ugw']:
+            jid = jidmap.conversation_jid(conversation_id, DOMAIN)
+            self.assertEqual(jid.domain, DOMAIN)
+            self.assertEqual(jidmap.lookup(jid.bare, DOMAIN), conversation_id)
+        self.assertNotEqual(jidmap.conversation_jid('UGW', DOMAIN),
+                            jidmap.conversation_jid('ugw', DOMAIN))
+
+    def test_not_contact(self):
+        self.assertIsNone(jidmap.lookup('user@example.com', DOMAIN))
+        self.assertIsNone(jidmap.lookup(DOMAIN, DOMAIN))
+
+    def test_parse_jid(self):
+        jid = jidmap.parse_jid('user@example.com/asdf')
+        self.assertEqual(jid.bare, 'user@example.com')
+        self.assertIs(jidmap.parse_jid('user@example.com/asdf'), jid)
+
+
+class TestComponentJIDs(TestCase):
+    def setUp(self):
+        self.xmpp = XHauntComponent(DOMAIN, 'secret', '127.0.0.1', 1234, 'testxhang')
+
+    def test_contacts(self):
+        user_id = UserID(chat_id='1234', gaia_id='1234')
+        self.assertEqual(self.xmpp.contact_jid(user_id), JID('1234@hangouts.example.net'))
+        self.assertEqual(self.xmpp.contact_id(JID('1234@hangouts.example.net/res')), user_id)
+
+        jid = self.xmpp.contact_jid('UgwConversation')
+        self.assertEqual(self.xmpp.contact_id(jid), 'UgwConversation')
+        self.assertIsNone(self.xmpp.contact_id(JID('user@example.com')))
@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+from unittest import TestCase
+from unittest.mock import patch
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from xml.etree import ElementTree as ET
+from slixmpp.stanza.iq import Iq
+
+from .component import XHauntComponent
+from .media import MediaRelay
+from .test_component import async_test, get_mock_coroutine
+
+ATTACHMENT = bytes(range(256)) * 4096
+
+
+class SourceServer:
+    """Local stand in for the Hangouts attachment host"""
+    def __init__(self):
+        app = web.Application()
+        app.router.add_get('/{name}', self.handle)
+        self.server = TestServer(app)
+
+    async def handle(self, request):
+        if request.match_info['name'] == 'missing':
+            raise web.HTTPNotFound()
+        response = web.StreamResponse(headers={'Content-Type': 'image/jpeg'})
+        if not request.match_info['name'].startswith('chunked'):
+            response.content_length = len(ATTACHMENT)
+        await response.prepare(request)
+        for start in range(0, len(ATTACHMENT), 8192):
+            await response.write(ATTACHMENT[start:start + 8192])
+        await response.write_eof()
+        return response
+
+
+class UploadServer:
+    """Local stand in for a XEP-0363 upload service"""
+    def __init__(self):
+        self.uploads = {}
+        self.headers = {}
+        self.active = 0
+        self.max_active = 0
+        app = web.Application()
+        app.router.add_put('/{name}', self.handle)
+        self.server = TestServer(app)
+
+    async def handle(self, request):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            digest = hashlib.sha1()
+            async for chunk in request.content.iter_chunked(4096):
+                digest.update(chunk)
+                await asyncio.sleep(0)
+            name = request.match_info['name']
+            self.uploads[name] = digest.hexdigest()
+            self.headers[name] = dict(request.headers)
+            return web.Response(status=201)
+        finally:
+            self.active -= 1
+
+
+class TestMediaRelay(TestCase):
+    @async_test
+    async def test_relay(self):
+        source = SourceServer()
+        upload = UploadServer()
+        await source.server.start_server()
+        await upload.server.start_server()
+        relay = MediaRelay(max_transfers=2, chunk_size=16384)
+        try:
+            names = ['file{}.jpg'.format(i) for i in range(4)] + ['chunked.jpg']
+            results = await asyncio.gather(*[
+                relay.relay(str(source.server.make_url('/' + name)),
+                            str(upload.server.make_url('/' + name)),
+                            len(ATTACHMENT),
+                            headers={'Authorization': 'Basic token'})
+                for name in names])
+
+            expected = hashlib.sha1(ATTACHMENT).hexdigest()
+            self.assertEqual(upload.uploads, {name: expected for name in names})
+            self.assertLessEqual(upload.max_active, 2)
+            self.assertEqual(upload.headers['file0.jpg']['Authorization'], 'Basic token')
+            self.assertEqual(upload.headers['file0.jpg']['Content-Type'], 'image/jpeg')
+            self.assertEqual(upload.headers['file0.jpg']['Content-Length'], str(len(ATTACHMENT)))
+            # the slot size is declared even when the source is chunked
+            self.assertEqual(upload.headers['chunked.jpg']['Content-Length'], str(len(ATTACHMENT)))
+            self.assertNotIn('Transfer-Encoding', upload.headers['chunked.jpg'])
+
+            for stats in results:
+                self.assertEqual(stats.bytes, len(ATTACHMENT))
+                self.assertGreater(stats.throughput, 0)
+            self.assertEqual(relay.totals['transfers'], 5)
+            self.assertEqual(relay.totals['bytes'], 5 * len(ATTACHMENT))
+            self.assertEqual(relay.active, 0)
+
+            with self.assertRaises(Exception):
+                await relay.relay(str(source.server.make_url('/missing')),
+                                  str(upload.server.make_url('/missing')), 1000)
+            self.assertEqual(relay.totals['failures'], 1)
+
+            # a source that isn't the size the slot was requested for
+            with self.assertRaises(ValueError):
+                await relay.relay(str(source.server.make_url('/file0.jpg')),
+                                  str(upload.server.make_url('/wrong.jpg')), 1000)
+            with self.assertRaises(Exception):
+                await relay.relay(str(source.server.make_url('/chunked.jpg')),
+                                  str(upload.server.make_url('/wrong.jpg')), len(ATTACHMENT) + 1)
+            self.assertNotIn('wrong.jpg', upload.uploads)
+            self.assertEqual(relay.totals['failures'], 3)
+        finally:
+            await relay.close()
+            await source.server.close()
+            await upload.server.close()
+
+
+class TestComponentUpload(TestCase):
+    def setUp(self):
+        self.xmpp = XHauntComponent('hangouts.example.net', 'secret', '127.0.0.1', 1234, 'testxhang',
+                                    upload_service='upload.example.com')
+
+    @async_test
+    async def test_relay_attachment(self):
+        result = Iq(stype='result')
+        result.set_payload(ET.fromstring('''
+<slot xmlns="urn:xmpp:http:upload:0">
+  <put url="https://upload.example.com/abc/photo.jpg">
+    <header name="Authorization">Basic token</header>
+    <header name="X-Not-Allowed">nope</header>
+  </put>
+  <get url="https://download.example.com/abc/photo.jpg"/>
+</slot>'''))
+        requests = []
+
+        async def send(self, *args, **kwargs):
+            requests.append(self)
+            return result
+
+        with patch.object(Iq, 'send', new=send), \
+             patch.object(self.xmpp.media, 'relay', wraps=get_mock_coroutine(return_value=None)) as relay, \
+             patch.object(self.xmpp, 'deliver') as deliver:
+            await self.xmpp.relay_attachment(
+                'user@example.com', '1234@hangouts.example.net',
+                'https://hangouts.example.com/photo', 'photo.jpg', 1000, 'image/jpeg')
+
+            request = requests[0].xml.find('{urn:xmpp:http:upload:0}request')
+            self.assertEqual(requests[0]['to'], 'upload.example.com')
+            self.assertEqual(request.get('size'), '1000')
+            self.assertEqual(request.get('content-type'), 'image/jpeg')
+
+            relay.assert_called_with(
+                'https://hangouts.example.com/photo', 'https://upload.example.com/abc/photo.jpg',
+                1000, {'Authorization': 'Basic token'}, 'image/jpeg')
+            msg = deliver.call_args[0][0]
+            self.assertEqual(msg['body'], 'https://download.example.com/abc/photo.jpg')
+            self.assertEqual(msg.xml.find('{jabber:x:oob}x/{jabber:x:oob}url').text,
+                             'https://download.example.com/abc/photo.jpg')
@@ -0,0 +1,103 @@
+from unittest import TestCase
+
+from .test_component import async_test
+from .db import Users, Roster
+from .migrations import MIGRATIONS, explain_node_types
+
+from hangups.user import UserID
+
+
+class TestMigrations(TestCase):
+    def setUp(self):
+        self.database = 'xhangtest_migrations'
+
+    @async_test
+    async def test_upgrade_is_idempotent(self):
+        users = Users(database=self.database)
+        roster = Roster(database=self.database)
+        try:
+            await users._create_database_if_needed()
+            applied = await users.upgrade_schema()
+            self.assertEqual(applied, [m[0] for m in MIGRATIONS])
+
+            # second start must not fail or reapply anything
+            await users.create_table_if_needed()
+            await roster.create_table_if_needed()
+            self.assertEqual(await users.upgrade_schema(), [])
+        finally:
+            users.close()
+            roster.close()
+            await users._drop_database()
+
+    @async_test
+    async def test_upgrade_legacy_schema(self):
+        users = Users(database=self.database)
+        try:
+            await users._create_database_if_needed()
+            await users.connect()
+            cur = await users.conn.cursor()
+            # schema as created before migrations existed, with a duplicate roster row
+            await cur.execute("""
+create table users (
+            id serial primary key,
+            jid varchar(255) unique,
+            username varchar(255),
+            token varchar(255));
+create index user_jid_index on users using hash (jid);
+create table roster (
+            id serial primary key,
+            jid varchar(255) references users (jid) on delete cascade,
+            gaia_id varchar(255),
+            chat_id varchar(255)
+);
+create index roster_jid_index on roster using hash (jid);
+create index roster_user_id_index on roster (gaia_id, chat_id);
+insert into users (jid, username) values ('test@example.org', 'hangouts1');
+insert into roster (jid, gaia_id, chat_id) values ('test@example.org', '1', '1');
+insert into roster (jid, gaia_id, chat_id) values ('test@example.org', '1', '1');
+""")
+            await users.upgrade_schema()
+
+            cur = await users.conn.cursor()
+            await cur.execute("select indexname from pg_indexes where tablename in ('users', 'roster')")
+            indexes = set(row[0] for row in await cur.fetchall())
+            self.assertEqual(indexes, {'users_pkey', 'users_jid_key', 'roster_pkey', 'roster_jid_user_id_key'})
+
+            await cur.execute('select count(*) from roster')
+            self.assertEqual((await cur.fetchone())[0], 1)
+        finally:
+            users.close()
+            await users._drop_database()
+
+    @async_test
+    async def test_hot_queries_use_indexes(self):
+        users = Users(database=self.database)
+        roster = Roster(database=self.database)
+        try:
+            jid = 'test@example.org'
+            await users._create_database_if_needed()
+            await users.create_table_if_needed()
+            await users.add_account(jid, 'hangouts1', 'pw1')
+            await roster.add_user_id(jid, UserID(gaia_id='1234567890', chat_id='1234567890'))
+
+            await users.connect()
+            cur = await users.conn.cursor()
+            # the tables are tiny, so stop the planner preferring a sequential scan
+            await cur.execute('set enable_seqscan = off')
+            hot_queries = [
+                ('select username, token from users where jid=%s', (jid,)),
+                ('select gaia_id, chat_id from roster where jid=%s', (jid,)),
+                ('select count(*) from roster where jid=%s', (jid,)),
+                ('delete from roster where jid=%s and gaia_id=%s and chat_id=%s',
+                 (jid, '1234567890', '1234567890')),
+            ]
+            for query, parameters in hot_queries:
+                node_types = await explain_node_types(cur, query, parameters)
+                self.assertTrue(
+                    node_types & {'Index Scan', 'Index Only Scan', 'Bitmap Index Scan'},
+                    '{} planned as {}'.format(query, node_types))
+                self.assertNotIn('Seq Scan', node_types)
+        finally:
+            users.close()
+            roster.close()
+            await users._drop_database()
@@ -0,0 +1,134 @@
+import asyncio
+from unittest import TestCase
+from unittest.mock import patch
+
+from slixmpp.stanza.message import Message
+from slixmpp.stanza.presence import Presence
+
+from .component import XHauntComponent
+from .db import Users
+from .offline import OfflineQueue
+from .test_component import async_test
+from .throttle import TokenBucket
+
+
+class TestOfflineQueue(TestCase):
+    def setUp(self):
+        self.database = 'xhangtest_offline'
+
+    @async_test
+    async def test_redeliver_in_order(self):
+        users = Users(database=self.database)
+        offline = OfflineQueue(database=self.database, max_items=10, max_delay=0.01)
+        try:
+            await users._create_database_if_needed()
+            await users.create_table_if_needed()
+
+            futures = [offline.enqueue('user@example.org', '<message>{}</message>'.format(i))
+                       for i in range(25)]
+            other = offline.enqueue('other@example.org', '<message>other</message>')
+            ids = await asyncio.gather(*futures)
+            self.assertEqual(ids, sorted(ids))
+            await other
+
+            # left in the write buffer, must still be redelivered
+            offline.enqueue('user@example.org', '<message>late</message>')
+
+            sent = []
+            delivered = await offline.redeliver('user@example.org', sent.append, batch_size=10)
+            self.assertEqual(delivered, 26)
+            self.assertEqual(sent, ['<message>{}</message>'.format(i) for i in range(25)] +
+                             ['<message>late</message>'])
+            self.assertEqual(await offline.count('user@example.org'), 0)
+            self.assertEqual(await offline.count(), 1)
+        finally:
+            await offline.queue.close()
+            users.close()
+            offline.close()
+            await users._drop_database()
+
+    @async_test
+    async def test_redeliver_stops_when_unavailable(self):
+        users = Users(database=self.database)
+        offline = OfflineQueue(database=self.database, max_items=10, max_delay=0.01)
+        try:
+            await users._create_database_if_needed()
+            await users.create_table_if_needed()
+            await asyncio.gather(*[offline.enqueue('user@example.org', str(i)) for i in range(5)])
+
+            sent = []
+            redelivery = offline.redeliver('user@example.org', sent.append,
+                                           available=lambda: len(sent) < 3)
+            self.assertTrue(offline.is_draining('user@example.org'))
+            self.assertEqual(await redelivery, 3)
+            self.assertFalse(offline.is_draining('user@example.org'))
+            self.assertEqual(sent, ['0', '1', '2'])
+            # the rest are still queued for next time
+            self.assertEqual([stanza for i, stanza in await offline.fetch('user@example.org')],
+                             ['3', '4'])
+        finally:
+            await offline.queue.close()
+            users.close()
+            offline.close()
+            await users._drop_database()
+
+    @async_test
+    async def test_redeliver_rate_limited(self):
+        users = Users(database=self.database)
+        offline = OfflineQueue(database=self.database, max_items=10, max_delay=0.01)
+        try:
+            await users._create_database_if_needed()
+            await users.create_table_if_needed()
+            await asyncio.gather(*[offline.enqueue('user@example.org', str(i)) for i in range(5)])
+
+            bucket = TokenBucket(rate=1000, capacity=2)
+            with patch.object(bucket, 'wait', wraps=bucket.wait) as wait:
+                sent = []
+                await offline.redeliver('user@example.org', sent.append, bucket=bucket)
+                self.assertEqual(wait.call_count, 5)
+            self.assertEqual(sent, [str(i) for i in range(5)])
+        finally:
+            users.close()
+            offline.close()
+            await users._drop_database()
+
+
+class TestComponentDelivery(TestCase):
+    @async_test
+    async def test_deliver_queues_while_offline(self):
+        xmpp = XHauntComponent('hangouts.example.net', 'secret', '127.0.0.1', 1234, 'testxhang')
+        drained = asyncio.get_event_loop().create_future()
+
+        def redeliver(target, send, bucket=None, available=None):
+            xmpp.offline._draining.add(target)
+            return drained
+
+        with patch.object(xmpp.offline, 'enqueue') as enqueue, \
+             patch.object(xmpp.offline, 'redeliver', side_effect=redeliver) as offline_redeliver, \
+             patch.object(Message, 'send') as send:
+            msg = xmpp.make_message(mto='user@example.com', mfrom='1@hangouts.example.net', mbody='hi')
+            xmpp.deliver(msg)
+            enqueue.assert_called_with('user@example.com', str(msg))
+            self.assertFalse(send.called)
+
+            presence = Presence()
+            presence['from'] = 'user@example.com/asdf'
+            xmpp.presence_available(presence)
+            self.assertEqual(offline_redeliver.call_args[0][0], 'user@example.com')
+            available = offline_redeliver.call_args[1]['available']
+            self.assertTrue(available())
+
+            # still behind the backlog being redelivered
+            enqueue.reset_mock()
+            xmpp.deliver(msg)
+            self.assertTrue(enqueue.called)
+            self.assertFalse(send.called)
+
+            xmpp.offline._draining.discard('user@example.com')
+            drained.set_result(1)
+            xmpp.deliver(msg)
+            send.assert_called_with()
+
+            xmpp.presence_unavailable(presence)
+            self.assertEqual(xmpp.available, {})
+            self.assertFalse(available())
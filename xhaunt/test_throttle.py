@@ -0,0 +1,260 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch
+
+from hangups.auth import GoogleAuthError
+from slixmpp.stanza.iq import Iq
+from slixmpp.stanza.message import Message
+from xml.etree import ElementTree as ET
+
+from .component import XHauntComponent
+from .test_component import async_test
+from .throttle import CircuitBreaker, Scheduler, Throttled, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(TestCase):
+    def test_burst_then_refill(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+
+        for i in range(3):
+            self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        self.assertAlmostEqual(bucket.delay(), 0.5)
+
+        clock.now += 0.5
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+        # never refills past capacity
+        self.assertFalse(bucket.full())
+        clock.now += 60
+        self.assertTrue(bucket.full())
+        self.assertEqual(bucket.delay(3), 0)
+        self.assertAlmostEqual(bucket.delay(4), 0.5)
+
+
+class TestCircuitBreaker(TestCase):
+    def test_open_and_close(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(threshold=2, backoff=10, max_backoff=25, clock=clock)
+
+        breaker.failure('user@example.com')
+        breaker.check('user@example.com')
+        breaker.failure('user@example.com')
+        with self.assertRaises(Throttled) as context:
+            breaker.check('user@example.com')
+        self.assertEqual(context.exception.retry_after, 10)
+        # other accounts are unaffected
+        breaker.check('other@example.com')
+
+        # half open after the backoff, another failure doubles it
+        clock.now += 10
+        breaker.check('user@example.com')
+        breaker.failure('user@example.com')
+        with self.assertRaises(Throttled) as context:
+            breaker.check('user@example.com')
+        self.assertEqual(context.exception.retry_after, 20)
+
+        # capped at max_backoff
+        clock.now += 20
+        breaker.failure('user@example.com')
+        with self.assertRaises(Throttled) as context:
+            breaker.check('user@example.com')
+        self.assertEqual(context.exception.retry_after, 25)
+
+        clock.now += 25
+        breaker.success('user@example.com')
+        breaker.failure('user@example.com')
+        breaker.check('user@example.com')
+        self.assertEqual(breaker.stats, {'opened': 3, 'rejected': 3})
+
+
+class TestScheduler(TestCase):
+    @async_test
+    async def test_fair_order(self):
+        clock = FakeClock()
+        scheduler = Scheduler(concurrency=1, clock=clock)
+        order = []
+
+        def operation(name):
+            async def run():
+                order.append(name)
+                return name
+            return run
+
+        # blocker holds the only slot while the backlogs queue up
+        release = asyncio.get_event_loop().create_future()
+
+        async def blocker():
+            await release
+        first = scheduler.submit('busy@example.com', blocker)
+
+        futures = [scheduler.submit('busy@example.com', operation('busy{}'.format(i)))
+                   for i in range(4)]
+        futures.append(scheduler.submit('quiet@example.com', operation('quiet')))
+        self.assertEqual(len(scheduler), 5)
+
+        release.set_result(None)
+        await asyncio.gather(first, *futures)
+        # quiet's one message does not wait behind busy's backlog
+        self.assertEqual(order, ['quiet', 'busy0', 'busy1', 'busy2', 'busy3'])
+        self.assertEqual(scheduler.stats['completed'], 6)
+
+    @async_test
+    async def test_throttle(self):
+        clock = FakeClock()
+        scheduler = Scheduler(jid_rate=1, jid_burst=2, conversation_rate=1, conversation_burst=1,
+                              clock=clock)
+
+        async def operation():
+            raise ValueError()
+
+        future = scheduler.submit('user@example.com', operation, 'conversation')
+        with self.assertRaises(Throttled) as context:
+            scheduler.submit('other@example.com', operation, 'conversation')
+        self.assertEqual(context.exception.reason, 'conversation')
+
+        scheduler.submit('user@example.com', operation)
+        with self.assertRaises(Throttled) as context:
+            scheduler.submit('user@example.com', operation)
+        self.assertEqual(context.exception.reason, 'user@example.com')
+
+        # refused operations do not use up tokens
+        clock.now += 1
+        scheduler.submit('other@example.com', operation, 'conversation')
+
+        with self.assertRaises(ValueError):
+            await future
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.stats['queued'], 3)
+        self.assertEqual(scheduler.stats['failed'], 3)
+        self.assertEqual(scheduler.stats['throttled_jid'], 1)
+        self.assertEqual(scheduler.stats['throttled_conversation'], 1)
+
+    @async_test
+    async def test_sweep(self):
+        clock = FakeClock()
+        scheduler = Scheduler(jid_rate=1, jid_burst=2, conversation_rate=1, conversation_burst=2,
+                              clock=clock, sweep_interval=10)
+
+        async def operation():
+            return None
+
+        await scheduler.submit('user@example.com', operation, 'conversation')
+        await scheduler.submit('other@example.com', operation)
+        self.assertEqual(len(scheduler.jid_buckets), 2)
+        self.assertEqual(len(scheduler._finish), 2)
+
+        # user is still refilling when the sweep runs, other is not
+        clock.now += 9.5
+        await scheduler.submit('user@example.com', operation, 'conversation')
+        await scheduler.submit('user@example.com', operation)
+        clock.now += 0.5
+        await scheduler.submit('third@example.com', operation)
+        self.assertEqual(set(scheduler.jid_buckets), {'user@example.com', 'third@example.com'})
+        self.assertEqual(set(scheduler.conversation_buckets), {'conversation'})
+        self.assertEqual(set(scheduler._finish), {'user@example.com', 'third@example.com'})
+
+        # full buckets go at the next sweep, finish times once the
+        # virtual time has caught up with them
+        clock.now += 60
+        await scheduler.submit('third@example.com', operation)
+        self.assertEqual(set(scheduler.jid_buckets), {'third@example.com'})
+        self.assertEqual(scheduler.conversation_buckets, {})
+        self.assertEqual(set(scheduler._finish), {'user@example.com', 'third@example.com'})
+        clock.now += 10
+        await scheduler.submit('third@example.com', operation)
+        self.assertEqual(set(scheduler._finish), {'third@example.com'})
+
+
+class TestComponentThrottle(TestCase):
+    def make_component(self):
+        return XHauntComponent('hangouts.example.net', 'secret', '127.0.0.1', 1234, 'testxhang')
+
+    @async_test
+    async def test_outbound_throttled(self):
+        self.xmpp = self.make_component()
+        self.xmpp.scheduler = Scheduler(jid_rate=1, jid_burst=1)
+        sent = []
+
+        async def operation():
+            return 'sent'
+
+        msg = Message(stype='chat')
+        msg['from'] = 'user@example.com/asdf'
+        msg['to'] = '1234@hangouts.example.net'
+        with patch.object(Message, 'send', new=lambda self: sent.append(self)):
+            self.assertEqual(await self.xmpp.outbound(msg, operation), 'sent')
+            self.assertIsNone(self.xmpp.outbound(msg, operation))
+
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]['type'], 'error')
+        self.assertEqual(sent[0]['to'], 'user@example.com/asdf')
+        self.assertEqual(sent[0]['error']['type'], 'wait')
+        self.assertEqual(sent[0]['error']['condition'], 'resource-constraint')
+
+    @async_test
+    async def test_auth_breaker(self):
+        self.xmpp = self.make_component()
+        self.xmpp.auth_breaker = CircuitBreaker(threshold=1)
+
+        def get_auth(*args):
+            raise GoogleAuthError('bad password')
+
+        with patch('xhaunt.auth.get_auth', new=get_auth), \
+             patch('concurrent.futures.ProcessPoolExecutor', new=ThreadPoolExecutor):
+            with self.assertRaises(GoogleAuthError):
+                await self.xmpp.get_auth_async('user@example.com', 'user@gmail.com', 'password')
+            with self.assertRaises(Throttled):
+                await self.xmpp.get_auth_async('user@example.com', 'user@gmail.com', 'password')
+        self.assertEqual(self.xmpp.auth_breaker.stats['rejected'], 1)
+
+    @async_test
+    async def test_register_not_authorized(self):
+        self.xmpp = XHauntComponent('hangouts.example.net', 'secret', '127.0.0.1', 1234,
+                                    'xhangtest_throttle')
+        self.xmpp.auth_breaker = CircuitBreaker(threshold=2)
+        users = self.xmpp.users
+
+        def get_auth(*args):
+            raise GoogleAuthError('bad password')
+
+        form = ET.fromstring('''
+<x xmlns="jabber:x:data" type="submit">
+  <field var="username"><value>user@gmail.com</value></field>
+  <field var="password"><value>wrong</value></field>
+</x>''')
+        iq = Iq(stype='set')
+        iq['from'] = 'user@example.com/asdf'
+        iq['to'] = 'hangouts.example.net'
+        try:
+            await users._create_database_if_needed()
+            await users.create_table_if_needed()
+            with patch('xhaunt.auth.get_auth', new=get_auth), \
+                 patch('concurrent.futures.ProcessPoolExecutor', new=ThreadPoolExecutor):
+                # registering again must not trip over the account row
+                # left by the first attempt
+                replies = [await self.xmpp.register_create_account(iq, [form]) for i in range(3)]
+
+            for reply in replies:
+                self.assertEqual(reply['type'], 'error')
+                self.assertEqual(reply['to'], 'user@example.com/asdf')
+            for reply in replies[:2]:
+                self.assertEqual(reply['error']['type'], 'auth')
+                self.assertEqual(reply['error']['condition'], 'not-authorized')
+            self.assertEqual(replies[2]['error']['type'], 'wait')
+            self.assertEqual(self.xmpp.auth_breaker.stats['rejected'], 1)
+            self.assertEqual(await users.count(), 1)
+        finally:
+            users.close()
+            await users._drop_database()
@@ -0,0 +1,228 @@
+import asyncio
+from collections import Counter
+import functools
+import heapq
+import itertools
+import time
+
+
+class Throttled(Exception):
+    """An operation was refused, and may be retried after retry_after seconds
+    """
+    def __init__(self, reason, retry_after):
+        super(Throttled, self).__init__(
+            '{} throttled, retry in {:.1f}s'.format(reason, retry_after))
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allow bursts of up to capacity operations, refilled at rate per second
+
+    :args:
+       rate (float): tokens added per second
+       capacity (float): most tokens the bucket can hold
+       clock: function returning the current time in seconds
+    """
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, tokens=1):
+        """Seconds until tokens will be available, 0 if they are now
+        """
+        self._refill()
+        if self.tokens >= tokens:
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+    def full(self):
+        """Has the bucket refilled to capacity
+        """
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def consume(self, tokens=1):
+        """Take tokens if available
+
+        :returns:
+           True if the tokens were taken, False if the caller should wait
+        """
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def wait(self, tokens=1):
+        """Sleep until tokens are available, then take them
+        """
+        while not self.consume(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+
+class CircuitBreaker:
+    """Stop retrying an account after repeated failures
+
+    After threshold consecutive failures the circuit for that key opens
+    for backoff seconds, doubling with every further failure up to
+    max_backoff. While open, check() raises Throttled. Once the backoff
+    has passed calls are let through again, and a success closes the
+    circuit.
+    """
+    def __init__(self, threshold=3, backoff=30, max_backoff=3600, clock=time.monotonic):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.failures = {}
+        self.open_until = {}
+        self.stats = Counter()
+
+    def check(self, key):
+        until = self.open_until.get(key)
+        if until is None:
+            return
+
+        now = self.clock()
+        if now < until:
+            self.stats['rejected'] += 1
+            raise Throttled(key, until - now)
+
+    def success(self, key):
+        self.failures.pop(key, None)
+        self.open_until.pop(key, None)
+
+    def failure(self, key):
+        failures = self.failures[key] = self.failures.get(key, 0) + 1
+        if failures >= self.threshold:
+            backoff = min(self.max_backoff, self.backoff * 2 ** (failures - self.threshold))
+            self.open_until[key] = self.clock() + backoff
+            self.stats['opened'] += 1
+
+
+class Scheduler:
+    """Rate limit and fairly order operations sent to Hangouts
+
+    Every operation belongs to a user, by bare JID, and optionally a
+    conversation, each with its own TokenBucket. An operation arriving
+    while either bucket is empty is refused with Throttled rather than
+    queued. Accepted operations run at most concurrency at a time, in
+    start-time fair queuing order, so a user with a deep backlog only
+    takes their weighted share of the slots.
+
+    :args:
+       concurrency (int): operations allowed to run at once
+       jid_rate, jid_burst: token bucket settings per user
+       conversation_rate, conversation_burst: token bucket settings
+           per conversation
+       sweep_interval (float): seconds between dropping the state kept
+           for users and conversations that have gone quiet
+    """
+    def __init__(self, concurrency=4, jid_rate=5, jid_burst=20,
+                 conversation_rate=2, conversation_burst=10, clock=time.monotonic,
+                 sweep_interval=60):
+        self.concurrency = concurrency
+        self.jid_rate = jid_rate
+        self.jid_burst = jid_burst
+        self.conversation_rate = conversation_rate
+        self.conversation_burst = conversation_burst
+        self.clock = clock
+        self.jid_buckets = {}
+        self.conversation_buckets = {}
+        # jid -> relative share of the slots, defaults to 1
+        self.weights = {}
+        self.running = 0
+        self.stats = Counter()
+        self._queue = []
+        self._finish = {}
+        self._virtual_time = 0
+        self._sequence = itertools.count()
+        self.sweep_interval = sweep_interval
+        self._next_sweep = clock() + sweep_interval
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _bucket(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst, self.clock)
+        return bucket
+
+    def submit(self, jid, operation, conversation_id=None, cost=1):
+        """Queue operation, a coroutine function, to run on behalf of jid
+
+        :returns:
+           future set to the result of operation()
+
+        raises Throttled if jid or the conversation is over its rate
+        """
+        if self.clock() >= self._next_sweep:
+            self._sweep()
+        buckets = [('jid', self._bucket(self.jid_buckets, jid, self.jid_rate, self.jid_burst))]
+        if conversation_id is not None:
+            buckets.append(('conversation', self._bucket(
+                self.conversation_buckets, conversation_id,
+                self.conversation_rate, self.conversation_burst)))
+        for name, bucket in buckets:
+            delay = bucket.delay(cost)
+            if delay > 0:
+                self.stats['throttled_' + name] += 1
+                raise Throttled(jid if name == 'jid' else conversation_id, delay)
+        for name, bucket in buckets:
+            bucket.consume(cost)
+
+        start = max(self._virtual_time, self._finish.get(jid, 0))
+        self._finish[jid] = start + cost / self.weights.get(jid, 1)
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._queue, (start, next(self._sequence), operation, future))
+        self.stats['queued'] += 1
+        self._dispatch()
+        return future
+
+    def _sweep(self):
+        """Forget buckets and finish times that no longer matter
+
+        A full bucket acts like a new one, and submit ignores a finish
+        time at or before the virtual time, so dropping them changes
+        nothing but memory use.
+        """
+        self._next_sweep = self.clock() + self.sweep_interval
+        for buckets in (self.jid_buckets, self.conversation_buckets):
+            for key in [key for key, bucket in buckets.items() if bucket.full()]:
+                del buckets[key]
+        for jid in [jid for jid, finish in self._finish.items() if finish <= self._virtual_time]:
+            del self._finish[jid]
+
+    def _dispatch(self):
+        while self._queue and self.running < self.concurrency:
+            start, sequence, operation, future = heapq.heappop(self._queue)
+            self._virtual_time = start
+            if future.cancelled():
+                continue
+            self.running += 1
+            task = asyncio.ensure_future(operation())
+            task.add_done_callback(functools.partial(self._done, future))
+
+    def _done(self, future, task):
+        self.running -= 1
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            self.stats['failed'] += 1
+            if not future.cancelled():
+                future.set_exception(task.exception())
+        else:
+            self.stats['completed'] += 1
+            if not future.cancelled():
+                future.set_result(task.result())
+        self._dispatch()